@@ -0,0 +1,163 @@
+import os, time, json, platform, subprocess
+import emu
+
+# run_opcode per opcode class, each sequence leaves sp/pc where it found them
+OPCODE_CLASSES = {
+	'nop':      ((0x00, None),),
+	'ld_r_r':   ((0x78, None), (0x4F, None), (0x57, None)),
+	'ld_r_imm': ((0x06, 0x12), (0x3E, 0x34), (0x0E, 0x56)),
+	'inc_dec':  ((0x04, None), (0x0D, None), (0x3D, None)),
+	'alu':      ((0x90, None), (0xFE, 0x90), (0xAF, None), (0x86, None)),
+	'ld_mem':   ((0x77, None), (0x1A, None), (0xEA, 0xC100), (0x22, None), (0x32, None)),
+	'ldh':      ((0xE0, 0x80), (0xF0, 0x80), (0xE2, None)),
+	'rotate':   ((0x07, None), (0x17, None)),
+	'stack':    ((0xC5, None), (0xC1, None), (0xCD, 0x0150), (0xC9, None)),
+	'jump':     ((0x18, 0x00), (0x20, 0x00), (0x28, 0x00), (0xC3, 0x0150)),
+}
+
+# one address per mapped region, (name, address, writable)
+REGIONS = (
+	('rom0', 0x0150, False),
+	('romn', 0x4150, False),
+	('vram', 0x8010, True),
+	('wram', 0xC010, True),
+	('echo', 0xE010, True),
+	('io',   0xFF40, True),
+	('hram', 0xFF90, True),
+)
+
+def best_rate(fn, n, repeat):
+	# fn runs <n> operations, returns the best rate over <repeat> runs
+	best = 0
+	for _ in range(repeat):
+		t = time.perf_counter()
+		fn()
+		dt = time.perf_counter() - t
+		best = max(best, n / dt)
+	return best
+
+def make_emu(fn, bootrom=None):
+	e = emu.Emu(bootrom)
+	e.load_rom(emu.ROM(fn))
+	return e
+
+def bench_instructions(e, n):
+	bus = e.bus
+	t = time.perf_counter()
+	for _ in range(n):
+		bus.do_instruction()
+	return n / (time.perf_counter() - t)
+
+def bench_step(e, n):
+	bus = e.bus
+	t = time.perf_counter()
+	bus.run(n)
+	return n / (time.perf_counter() - t)
+
+def bench_regions(e, n, repeat):
+	bus = e.bus
+	out = {}
+	rng = range(n)
+	for name, adr, writable in REGIONS:
+		def read():
+			for _ in rng:
+				bus.read_at(adr)
+		out[f'read_at.{name}'] = best_rate(read, n, repeat)
+		if writable:
+			def write():
+				for _ in rng:
+					bus.write_at(adr, 0x5A)
+			out[f'write_at.{name}'] = best_rate(write, n, repeat)
+	return out
+
+def bench_opcodes(e, n, repeat):
+	cpu = e.cpu
+	out = {}
+	for name, seq in OPCODE_CLASSES.items():
+		ops = seq * max(1, n // len(seq))
+		def run():
+			cpu.reg_hl = 0xC000
+			cpu.reg_sp = 0xFFFE
+			for opcode, arg in ops:
+				cpu.run_opcode(opcode, arg)
+		out[f'run_opcode.{name}'] = best_rate(run, len(ops), repeat)
+	return out
+
+def bench_frames(fn, frames, repeat, bootrom=None):
+	out = {}
+	for name, trace in (('fast', 0), ('step', 1)):
+		def run():
+			e = make_emu(fn, bootrom)
+			e.bus.set_trace(trace)
+			for _ in range(frames):
+				e.bus.run_until_frame()
+		out[f'frame.{name}'] = best_rate(run, frames, repeat)
+	return out
+
+def bench_rom(fn, n, repeat):
+	def run():
+		for _ in range(n):
+			emu.ROM(fn)
+	return {'rom.construct': best_rate(run, n, repeat)}
+
+def git_commit():
+	try:
+		return subprocess.check_output(
+			['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run_suite(fn, n=100000, frames=30, repeat=3, bootrom=None):
+	results = {}
+	e = make_emu(fn, bootrom)
+	results.update(bench_regions(e, n, repeat))
+	results.update(bench_opcodes(e, n, repeat))
+	e = make_emu(fn, bootrom)
+	results['do_instruction'] = max(bench_instructions(e, n) for _ in range(repeat))
+	results['step'] = max(bench_step(e, n) for _ in range(repeat))
+	results.update(bench_frames(fn, frames, repeat, bootrom))
+	results.update(bench_rom(fn, 20, repeat))
+	return {
+		'meta': {
+			'rom': fn,
+			'commit': git_commit(),
+			'python': platform.python_version(),
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		},
+		# operations per second, higher is better
+		'results': results,
+	}
+
+def print_report(report, baseline=None):
+	base = baseline['results'] if baseline else {}
+	for name, rate in report['results'].items():
+		line = f'{name:<24} {rate:>14.1f} /s'
+		if name in base and base[name]:
+			line += f'   {rate / base[name]:>6.2f}x'
+		print(line)
+
+def main(argv=None):
+	import argparse
+	parser = argparse.ArgumentParser(description='Per-subsystem emulator benchmarks')
+	parser.add_argument('rom')
+	parser.add_argument('--bootrom', default=None)
+	parser.add_argument('-n', type=int, default=100000, help='operations per microbenchmark')
+	parser.add_argument('--frames', type=int, default=30)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--json', default=None, help='write results to this file')
+	parser.add_argument('--compare', default=None, help='earlier --json output to compare against')
+	args = parser.parse_args(argv)
+
+	report = run_suite(args.rom, args.n, args.frames, args.repeat, args.bootrom)
+	baseline = None
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+	print_report(report, baseline)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+	main()
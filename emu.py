@@ -1,4 +1,4 @@
-import struct, random
+import os, struct, random, mmap, collections, heapq, zlib
 
 OPCODES = {
 	0x00 : (0, 1, 'nop'),
@@ -8,7 +8,7 @@ OPCODES = {
 	0x04 : (0, 1, 'inc b'),
 	0x05 : (0, 1, 'dec b'),
 	0x06 : (1, 8, 'ld b, ${val:0>2X}'),
-	0x07 : (1, 1, 'rlca'),
+	0x07 : (0, 1, 'rlca'),
 	0x08 : (2, 5, 'ld [${val:0>4X}], sp'),
 	0x09 : (0, 2, 'add hl, bc'),
 	0x0A : (0, 2, 'ld a, [bc]'),
@@ -259,6 +259,14 @@ OPCODES = {
 	0xFF : (0, 4, 'rst $38'),
 }
 
+CB_REGS = ('b', 'c', 'd', 'e', 'h', 'l', '[hl]', 'a')
+CB_SHIFTS = ('rlc', 'rrc', 'rl', 'rr', 'sla', 'sra', 'swap', 'srl')
+CB_OPCODES = {}
+for i in range(0x40):
+	CB_OPCODES[i] = f'{CB_SHIFTS[i >> 3]} {CB_REGS[i & 7]}'
+for i in range(0x40, 0x100):
+	CB_OPCODES[i] = f'{("bit", "res", "set")[(i >> 6) - 1]} {(i >> 3) & 7}, {CB_REGS[i & 7]}'
+
 HEADER_LOGO = \
 	b'\xCE\xED\x66\x66\xCC\x0D\x00\x0B' + \
 	b'\x03\x73\x00\x83\x00\x0C\x00\x0D' + \
@@ -301,43 +309,143 @@ CART_DATA = {
 inrng = lambda x, a, b: a <= x and x <= b
 
 class MBC:
-	def __init__(self, ver):
+	# no banking, also the base of the real controllers. A bank write only
+	# rebinds one of the ROM's precomputed bank views
+	def __init__(self, ver, rom=None):
 		self.ver = ver
+		self.rom = rom
 
 		self.rom_bank = 1
 		self.ram_bank = 0
-		self.ram_loaded = False
+		# cart RAM enabled, carts without a controller have no enable
+		# register and their RAM is always on
+		self.ram_loaded = ver is None
+		# MBC1 banking mode
+		self.mode = 0
 
 	def write_at(self, adr, val):
 		if inrng(adr, 0x0000, 0xFFFF):
 			pass
 
+	def enable_ram(self, val):
+		self.ram_loaded = val & 0x0F == 0x0A
+		if not self.ram_loaded:
+			# games disable RAM once they are done saving
+			self.rom.flush_ram()
+
+	def update(self):
+		# rebinds the views to the registers, e.g. after loading a state
+		self.rom.set_rom_bank(self.rom_bank)
+		self.rom.set_ram_bank(self.ram_bank)
+
+class MBC1(MBC):
+	def write_at(self, adr, val):
+		if adr < 0x2000:
+			self.enable_ram(val)
+		elif adr < 0x4000:
+			val &= 0x1F
+			if val == 0:
+				val = 1
+			self.rom_bank = (self.rom_bank & 0x60) | val
+			self.rom.set_rom_bank(self.rom_bank)
+		elif adr < 0x6000:
+			self.rom_bank = (self.rom_bank & 0x1F) | (val & 0x03) << 5
+			self.update()
+		elif adr < 0x8000:
+			self.mode = val & 0x01
+			self.update()
+
+	def update(self):
+		# the upper bits pick the bank at 0000 and the RAM bank in mode 1
+		self.rom.set_rom_bank(self.rom_bank)
+		if self.mode:
+			self.rom.set_rom_bank0(self.rom_bank & 0x60)
+			self.ram_bank = self.rom_bank >> 5
+		else:
+			self.rom.set_rom_bank0(0)
+			self.ram_bank = 0
+		self.rom.set_ram_bank(self.ram_bank)
+
+class MBC3(MBC):
+	def write_at(self, adr, val):
+		if adr < 0x2000:
+			self.enable_ram(val)
+		elif adr < 0x4000:
+			val &= 0x7F
+			if val == 0:
+				val = 1
+			self.rom_bank = val
+			self.rom.set_rom_bank(val)
+		elif adr < 0x6000:
+			# 08-0C select the clock registers, not emulated
+			self.ram_bank = val
+			self.update()
+		elif adr < 0x8000:
+			pass # clock latch
+
+	def update(self):
+		self.rom.set_rom_bank(self.rom_bank)
+		self.rom.set_ram_bank(self.ram_bank if self.ram_bank < 0x08 else None)
+
+class MBC5(MBC):
+	def write_at(self, adr, val):
+		if adr < 0x2000:
+			self.enable_ram(val)
+		elif adr < 0x3000:
+			self.rom_bank = (self.rom_bank & 0x100) | val
+			self.rom.set_rom_bank(self.rom_bank)
+		elif adr < 0x4000:
+			self.rom_bank = (self.rom_bank & 0xFF) | (val & 0x01) << 8
+			self.rom.set_rom_bank(self.rom_bank)
+		elif adr < 0x6000:
+			self.ram_bank = val & 0x0F
+			self.rom.set_ram_bank(self.ram_bank)
+
+MBC_TYPES = {
+	'MBC1': MBC1,
+	'MBC3': MBC3,
+	'MBC5': MBC5,
+}
+
 R_HEX   = 0
 R_INT   = 1
 R_UINT  = 2
 R_ASCII = 3
+# battery saves are written back in pages of this size, at most this many
+# cycles after the first write to a clean page
+SAV_PAGE = mmap.ALLOCATIONGRANULARITY
+SAV_FLUSH_CYCLES = 1048576
+
 class ROM:
 	def __init__(self, f_rom, f_sav=None):
 		self.bus = None
 
 		if isinstance(f_rom, str):
 			self.f_rom = open(f_rom, 'rb')
+		elif isinstance(f_rom, (bytes, bytearray, memoryview)):
+			# already in memory, e.g. shared between processes
+			self.f_rom = None
 		else:
 			self.f_rom = f_rom
-		if f_sav is None:
-			self.f_sav = None
-		elif isinstance(f_sav, str):
-			self.f_sav = open(f_sav, 'rb')
+		# the whole cartridge is kept in memory, everything below reads
+		# from it instead of the file
+		if self.f_rom is None:
+			self.data = f_rom
 		else:
-			self.f_sav = f_sav
+			self.data = self.map_file(self.f_rom)
+		if len(self.data) < 0x8000:
+			self.data = bytes(self.data).ljust(0x8000, b'\xFF')
+		self.view = memoryview(self.data)
+		self.bank_ct = len(self.data) // 0x4000
+		self.pos = 0
 		self.valid_rom = 0
 		# get some header info
 		self.header = {}
 		self.sk(0x104)
-		self.header['logo'] = self.f_rom.read(0x30)
+		self.header['logo'] = self.rd(0x30)
 		if self.header['logo'] != HEADER_LOGO:
 			self.valid_rom = 1
-		self.header['title'] = self.f_rom.read(0x10)
+		self.header['title'] = self.rd(0x10)
 		self.header['manufacturer'] = self.header['title'][0xB:0xF]
 		self.header['cgb'] = self.header['title'][0xF]
 		self.header['licensee'] = self.rh(R_HEX)
@@ -378,22 +486,134 @@ class ROM:
 		if chk != self.header['header_checksum']:
 			self.valid_rom = 5
 		# verify global checksum
-		self.sk(0)
-		cur_adr = 0
-		chk = 0
-		while True:
-			cur_h = self.f_rom.read(1)
-			if cur_h == b'': break
-			if cur_adr != 0x14E and cur_adr != 0x14F:
-				chk = (chk + struct.unpack('B', cur_h)[0]) & 0xFFFF
-			cur_adr += 1
+		chk = (sum(self.view) - self.view[0x14E] - self.view[0x14F]) & 0xFFFF
 		if chk != self.header['global_checksum']:
 			self.valid_rom = 6
 
+		# zero-copy views of every bank, switching just picks one
+		self.banks = [self.view[i * 0x4000:(i + 1) * 0x4000] for i in range(self.bank_ct)]
+		self.set_rom_bank0(0)
+
+		# cart RAM, the .sav is only used on carts with a battery
+		ram_ct = self.header['ramsize'][0] if isinstance(self.header['ramsize'], tuple) else 0
+		self.ram_ct = ram_ct
+		self.f_sav = None
+		self.sav_map = None
+		self.ram_dirty = set()
+		self.flush_event = None
+		cart = self.header['cartridge']
+		if ram_ct and not f_sav is None and not isinstance(cart, str) and 'BATTERY' in cart[1]:
+			self.ram = self.open_sav(f_sav, ram_ct * 0x2000)
+		else:
+			self.ram = bytearray(ram_ct * 0x2000)
+		self.set_ram_bank(0)
+
 		if self.valid_rom > 0:
-			self.mbc = MBC(None)
+			self.mbc = MBC(None, self)
+		else:
+			ver = self.header['cartridge'][0]
+			if not ver is None and not ver in MBC_TYPES:
+				print(f'Unsupported cartridge type {ver}, bank switching disabled')
+			self.mbc = MBC_TYPES.get(ver, MBC)(ver, self)
+		self.set_rom_bank(self.mbc.rom_bank)
+
+	def map_file(self, f):
+		# mmap when the file allows it, so every emulator open on the same
+		# cart shares the OS page cache copy
+		try:
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (AttributeError, OSError, ValueError):
+			f.seek(0)
+			return f.read()
+
+	def set_rom_bank(self, bank):
+		bank %= self.bank_ct
+		self.bankn = self.banks[bank]
+		self.bankn_id = bank
+
+	def set_rom_bank0(self, bank):
+		bank %= self.bank_ct
+		self.bank0 = self.banks[bank]
+		self.bank0_id = bank
+
+	def set_ram_bank(self, bank):
+		# <ram_ofs> is None where there is nothing to read, e.g. no RAM or
+		# the MBC3 clock registers (bank None)
+		if self.ram_ct == 0 or bank is None:
+			self.ram_ofs = None
 		else:
-			self.mbc = MBC(self.header['cartridge'][0])
+			self.ram_ofs = (bank % self.ram_ct) * 0x2000
+
+	def open_sav(self, f_sav, size):
+		# maps the .sav so that writes land in the page cache, flush_ram
+		# only has to push the dirty pages out
+		self.own_sav = isinstance(f_sav, str)
+		if self.own_sav:
+			mode = 'r+b' if os.path.exists(f_sav) else 'w+b'
+			f_sav = open(f_sav, mode)
+		self.f_sav = f_sav
+		f_sav.seek(0, os.SEEK_END)
+		if f_sav.tell() < size:
+			f_sav.write(bytes(size - f_sav.tell()))
+			f_sav.flush()
+		try:
+			self.sav_map = mmap.mmap(f_sav.fileno(), size)
+			return self.sav_map
+		except (AttributeError, OSError, ValueError):
+			f_sav.seek(0)
+			return bytearray(f_sav.read(size).ljust(size, b'\x00'))
+
+	def touch_ram(self):
+		# marks all of the cart RAM dirty, for writes that bypass write_at.
+		# The flush is timed from now, a pending one may belong to another
+		# timeline, e.g. before a rewind
+		if not self.f_sav is None:
+			self.ram_dirty.update(range((len(self.ram) + SAV_PAGE - 1) // SAV_PAGE))
+			if not self.flush_event is None:
+				self.bus.cancel(self.flush_event)
+				self.flush_event = None
+			self.schedule_flush()
+
+	def schedule_flush(self):
+		if self.flush_event is None and not self.bus is None:
+			self.flush_event = self.bus.schedule(self.bus.cycles + SAV_FLUSH_CYCLES, self.end_flush)
+
+	def end_flush(self, cycle):
+		self.flush_event = None
+		self.flush_ram()
+
+	def flush_ram(self):
+		# writes the dirty pages back to the .sav
+		if not self.ram_dirty:
+			return
+		size = len(self.ram)
+		for pg in sorted(self.ram_dirty):
+			ofs = pg * SAV_PAGE
+			n = min(SAV_PAGE, size - ofs)
+			if self.sav_map is None:
+				self.f_sav.seek(ofs)
+				self.f_sav.write(self.ram[ofs:ofs + n])
+			else:
+				self.sav_map.flush(ofs, n)
+		if self.sav_map is None:
+			self.f_sav.flush()
+		self.ram_dirty.clear()
+
+	def close(self):
+		# flushes and lets go of the .sav, the RAM stays usable
+		if self.f_sav is None:
+			return
+		if not self.flush_event is None:
+			self.bus.cancel(self.flush_event)
+			self.flush_event = None
+		self.flush_ram()
+		if not self.sav_map is None:
+			self.ram = bytearray(self.sav_map)
+			self.sav_map.close()
+			self.sav_map = None
+		if self.own_sav:
+			self.f_sav.close()
+		self.f_sav = None
 
 	def sk(self, arg1, arg2=None):
 		if arg2 is None:
@@ -401,16 +621,17 @@ class ROM:
 				b, a = arg1.split(':')
 				self.sk(int(b, 16), int(a, 16))
 			else:
-				self.f_rom.seek(arg1)
+				self.pos = arg1
 		else:
-			adr = arg2
-			if arg1 != 0:
-				arg2 -= 0x4000
-			adr += arg1 * 0x4000
-			self.f_rom.seek(adr)
+			self.pos = arg1 * 0x4000 + (arg2 & 0x3FFF)
+
+	def rd(self, n):
+		b = bytes(self.view[self.pos:self.pos + n])
+		self.pos += n
+		return b
 
 	def rb(self, mode=R_UINT):
-		b = self.f_rom.read(1)
+		b = self.rd(1)
 		if mode == R_HEX:
 			return b
 		if mode == R_UINT:
@@ -425,7 +646,7 @@ class ROM:
 		print(f'ERROR READ MODE {mode}')
 
 	def rh(self, mode=R_UINT):
-		h = self.f_rom.read(2)
+		h = self.rd(2)
 		if mode == R_HEX:
 			return h
 		if mode == R_UINT:
@@ -437,7 +658,7 @@ class ROM:
 		print(f'ERROR READ MODE {mode}')
 
 	def rhb(self, mode=R_UINT):
-		h = self.f_rom.read(2)
+		h = self.rd(2)
 		if mode == R_HEX:
 			return h
 		if mode == R_UINT:
@@ -454,33 +675,40 @@ class ROM:
 		if inrng(adr, 0x0000, 0x9FFF):
 			pass
 		elif inrng(adr, 0xA000, 0xBFFF):
-			if self.mbc.ram_loaded:
-				pass # TODO
-			else:
-				pass
+			if self.mbc.ram_loaded and not self.ram_ofs is None:
+				ofs = self.ram_ofs + adr - 0xA000
+				self.ram[ofs] = val
+				if not self.f_sav is None:
+					self.ram_dirty.add(ofs // SAV_PAGE)
+					self.schedule_flush()
 		elif inrng(adr, 0xC000, 0xFFFF):
 			pass
 
 	def read_at(self, adr):
 		# reads the ROM at 16-bit address <adr>
-		if inrng(adr, 0x0000, 0x3FFF):
+		if adr < 0x4000:
 			# bank-0
-			self.sk(adr)
-			return self.rb()
-		elif inrng(adr, 0x4000, 0x7FFF):
+			return self.bank0[adr]
+		elif adr < 0x8000:
 			# bank-n
-			self.sk(self.mbc.bank, adr)
-			return self.rb()
+			return self.bankn[adr - 0x4000]
 		elif inrng(adr, 0x8000, 0x9FFF):
 			return None
 		elif inrng(adr, 0xA000, 0xBFFF):
-			if self.mbc.ram_loaded:
-				return 0x00 # TODO
-			else:
+			if not self.mbc.ram_loaded:
 				return 0xFF
+			if self.ram_ofs is None:
+				return 0xFF if self.ram_ct == 0 else 0x00
+			return self.ram[self.ram_ofs + adr - 0xA000]
 		elif inrng(adr, 0xC000, 0xFFFF):
 			return None
 
+	def read_span(self, adr):
+		if adr < 0x4000:
+			return self.bank0, adr, 0x4000 - adr
+		elif adr < 0x8000:
+			return self.bankn, adr - 0x4000, 0x8000 - adr
+
 class VRAM:
 	def __init__(self):
 		self.bus = None
@@ -491,30 +719,62 @@ class VRAM:
 		# ~ self.bgmap0 = [0x00] * 0x400
 		# ~ self.bgmap1 = [0x00] * 0x400
 
-		self.tile0 = [random.randint(0, 255) for _ in range(0x800)]
-		self.tile1 = [random.randint(0, 255) for _ in range(0x800)]
-		self.tile2 = [random.randint(0, 255) for _ in range(0x800)]
-		self.bgmap0 = [random.randint(0, 255) for _ in range(0x400)]
-		self.bgmap1 = [random.randint(0, 255) for _ in range(0x400)]
+		# 8000-9FFF, <view> is a read-only view of all of it
+		self.data = bytearray(random.randbytes(0x2000))
+		self.view = memoryview(self.data).toreadonly()
+		mem = memoryview(self.data)
+		self.tile0 = mem[0x0000:0x0800]
+		self.tile1 = mem[0x0800:0x1000]
+		self.tile2 = mem[0x1000:0x1800]
+		self.bgmap0 = mem[0x1800:0x1C00]
+		self.bgmap1 = mem[0x1C00:0x2000]
 
 		self.vblank = True
 
+		# change tracking: every write stamps the tile (0-383) or map entry
+		# (0-2047, both maps) with the current serial. A consumer keeps the
+		# value checkpoint() gave it and later asks what changed since.
+		self.serial = 1
+		self.tile_serial = [0] * 384
+		self.map_serial = [0] * 0x800
+
 	def write_at(self, adr, val):
 		if inrng(adr, 0x0000, 0x7FFF):
 			pass
 		elif inrng(adr, 0x8000, 0x87FF):
 			self.tile0[adr - 0x8000] = val
+			self.tile_serial[(adr - 0x8000) >> 4] = self.serial
 		elif inrng(adr, 0x8800, 0x8FFF):
 			self.tile1[adr - 0x8800] = val
+			self.tile_serial[(adr - 0x8000) >> 4] = self.serial
 		elif inrng(adr, 0x9000, 0x97FF):
 			self.tile2[adr - 0x9000] = val
+			self.tile_serial[(adr - 0x8000) >> 4] = self.serial
 		elif inrng(adr, 0x9800, 0x9BFF):
 			self.bgmap0[adr - 0x9800] = val
+			self.map_serial[adr - 0x9800] = self.serial
 		elif inrng(adr, 0x9C00, 0x9FFF):
 			self.bgmap1[adr - 0x9C00] = val
+			self.map_serial[adr - 0x9800] = self.serial
 		elif inrng(adr, 0xA000, 0xFFFF):
 			pass
 
+	def checkpoint(self):
+		# everything written so far is at or below the returned serial
+		self.serial += 1
+		return self.serial - 1
+
+	def dirty_tiles(self, since):
+		return [i for i, s in enumerate(self.tile_serial) if s > since]
+
+	def dirty_map(self, since):
+		return [i for i, s in enumerate(self.map_serial) if s > since]
+
+	def touch_all(self):
+		# for bulk changes that bypass write_at, e.g. loading a state
+		self.tile_serial = [self.serial] * 384
+		self.map_serial = [self.serial] * 0x800
+
 	def read_at(self, adr):
 		if inrng(adr, 0x0000, 0x7FFF):
 			return None
@@ -546,37 +806,494 @@ class VRAM:
 		elif inrng(adr, 0xA000, 0xFFFF):
 			pass
 
+	def read_span(self, adr):
+		if self.vblank and inrng(adr, 0x8000, 0x9FFF):
+			return self.data, adr - 0x8000, 0xA000 - adr
+
+	def write_span(self, adr, n):
+		if inrng(adr, 0x8000, 0x9FFF):
+			n = min(n, 0xA000 - adr)
+			ofs = adr - 0x8000
+			for t in range(ofs >> 4, min(ofs + n, 0x1800) + 15 >> 4):
+				self.tile_serial[t] = self.serial
+			for i in range(max(ofs, 0x1800), ofs + n):
+				self.map_serial[i - 0x1800] = self.serial
+			return self.data, ofs, n
+
 	def set_vblank(self, state):
 		self.vblank = True
 
 
+# byte -> 8 bytes (as a big-endian int) holding its bits, MSB first
+SPREAD = [sum(((b >> k) & 1) << (8 * k) for k in range(8)) for b in range(0x100)]
+# palette register -> bytes.translate table for colour indices 0-3
+PALETTE_TABLES = [bytes((p >> (i * 2)) & 3 for i in range(4)) + bytes(0xFC) for p in range(0x100)]
+BLANK_LINE = bytes(160)
+
+class PPU:
+	def __init__(self):
+		self.bus = None
+
+		self.oam = bytearray(0xA0)
+		self.view = memoryview(self.oam).toreadonly()
+
+		# finished frames are 160x144 shades 0-3, <frame> is a read-only
+		# view of the latest one, valid until the next frame completes
+		self.front = bytearray(160 * 144)
+		self.back = bytearray(160 * 144)
+		self.frame = memoryview(self.front).toreadonly()
+		self.frame_count = 0
+
+		# decoded rows of all 384 tiles, stamped with the VRAM serial
+		self.tile_rows = [None] * 384
+		self.tile_stamp = [-1] * 384
+
+		self.line = 0
+		self.window_line = 0
+		self.frame_base = 0
+		self.line_event = None
+		# mode 0 STAT interrupt of the current line, None once it is done
+		self.hblank_event = None
+
+	def start(self):
+		self.bus.ioreg.read_hooks[0xFF41] = self.read_stat
+		self.bus.ioreg.write_hooks[0xFF46] = self.write_dma
+		self.bus.volatile[0xFF41] = self.stat_changes
+		self.bus.volatile[0xFF44] = self.ly_changes
+		self.bus.timing_hooks.append(self.resync)
+		self.resync()
+
+	def resync(self):
+		# puts the line events back in step with the bus frame timing
+		bus = self.bus
+		if not self.line_event is None:
+			bus.cancel(self.line_event)
+		self.frame_base = bus.frame_start
+		self.line = bus.get_ly()
+		self.line_event = bus.schedule(self.frame_base + LINE_END[self.line], self.end_line)
+		io = bus.ioreg.data
+		self.schedule_hblank(io[0x40] & 0x80 and io[0x41] & 0x08)
+
+	def schedule_hblank(self, on):
+		# (re)arms the hblank event of the current line
+		bus = self.bus
+		if not self.hblank_event is None:
+			bus.cancel(self.hblank_event)
+			self.hblank_event = None
+		ly = self.line
+		cycle = self.frame_base + LINE_START[ly] + 63
+		if on and ly < 144 and bus.cycles < cycle:
+			self.hblank_event = bus.schedule(cycle, self.hblank)
+
+	def restore(self, window_line, hblank):
+		# after the bus timing, see Emu.load_state
+		self.window_line = window_line
+		self.schedule_hblank(hblank)
+
+	def end_line(self, cycle):
+		bus = self.bus
+		lcd_on = bus.ioreg.data[0x40] & 0x80
+		ly = self.line
+		if ly == 0:
+			self.window_line = 0
+		if ly < 144:
+			self.render_line(ly)
+		if ly == 143:
+			# vblank
+			self.front, self.back = self.back, self.front
+			self.frame = memoryview(self.front).toreadonly()
+			self.frame_count += 1
+			if lcd_on:
+				bus.request_interrupt(INT_VBLANK)
+		if ly == 153:
+			self.line = 0
+			self.frame_base += FRAME_CYCLES
+		else:
+			self.line += 1
+		self.line_event = bus.schedule(self.frame_base + LINE_END[self.line], self.end_line)
+		if lcd_on:
+			self.start_line(self.line)
+
+	def start_line(self, ly):
+		# STAT interrupts due as line <ly> starts, and its hblank if enabled
+		io = self.bus.ioreg.data
+		stat = io[0x41]
+		if (stat & 0x40 and ly == io[0x45]) or (stat & 0x20 and ly < 144) or (stat & 0x10 and ly == 144):
+			self.bus.request_interrupt(INT_STAT)
+		if stat & 0x08 and ly < 144:
+			self.hblank_event = self.bus.schedule(self.frame_base + LINE_START[ly] + 63, self.hblank)
+
+	def hblank(self, cycle):
+		self.hblank_event = None
+		io = self.bus.ioreg.data
+		if io[0x40] & 0x80 and io[0x41] & 0x08:
+			self.bus.request_interrupt(INT_STAT)
+
+	def write_at(self, adr, val):
+		if inrng(adr, 0xFE00, 0xFE9F):
+			self.oam[adr - 0xFE00] = val
+
+	def read_at(self, adr):
+		if inrng(adr, 0xFE00, 0xFE9F):
+			return self.oam[adr - 0xFE00]
+		elif inrng(adr, 0xFEA0, 0xFEFF):
+			return 0x00
+
+	def read_span(self, adr):
+		if inrng(adr, 0xFE00, 0xFE9F):
+			return self.oam, adr - 0xFE00, 0xFEA0 - adr
+
+	def write_span(self, adr, n):
+		return self.read_span(adr)
+
+	def write_dma(self, val):
+		# OAM DMA, done all at once instead of over 160 cycles
+		self.bus.ioreg.data[0x46] = val
+		self.oam[:] = self.bus.read_range(val << 8, 0xA0)
+
+	def read_stat(self):
+		bus = self.bus
+		io = bus.ioreg.data
+		stat = 0x80 | (io[0x41] & 0x78)
+		if not io[0x40] & 0x80:
+			return stat
+		ly = bus.get_ly()
+		if ly == io[0x45]:
+			stat |= 0x04
+		if ly >= 144:
+			return stat | 1
+		dot = bus.frame_cycles - LINE_START[ly]
+		if dot < 20:
+			return stat | 2
+		if dot < 63:
+			return stat | 3
+		return stat
+
+	def ly_changes(self):
+		bus = self.bus
+		return bus.frame_start + LINE_END[bus.get_ly()]
+
+	def stat_changes(self):
+		# next line or mode change
+		bus = self.bus
+		ly = bus.get_ly()
+		start = bus.frame_start + LINE_START[ly]
+		if ly < 144:
+			for dot in (20, 63):
+				if bus.cycles < start + dot:
+					return start + dot
+		return bus.frame_start + LINE_END[ly]
+
+	def decode_tile(self, t):
+		vram = self.bus.vram
+		blk = vram.data
+		base = t * 16
+		self.tile_rows[t] = [
+			(SPREAD[blk[i]] | (SPREAD[blk[i + 1]] << 1)).to_bytes(8, 'big')
+			for i in range(base, base + 16, 2)
+		]
+		self.tile_stamp[t] = vram.checkpoint()
+
+	def bg_row(self, hi_map, lcdc, y):
+		# colour indices of a whole 256 pixel map row
+		vram = self.bus.vram
+		bgmap = vram.bgmap1 if hi_map else vram.bgmap0
+		base = (y >> 3) * 32
+		fy = y & 7
+		unsigned = lcdc & 0x10
+		serial = vram.tile_serial
+		stamp = self.tile_stamp
+		rows = self.tile_rows
+		parts = []
+		for t in bgmap[base:base + 32]:
+			if not unsigned and t < 0x80:
+				t += 0x100
+			if serial[t] > stamp[t]:
+				self.decode_tile(t)
+			parts.append(rows[t][fy])
+		return b''.join(parts)
+
+	def render_line(self, ly):
+		io = self.bus.ioreg.data
+		lcdc = io[0x40]
+		ofs = ly * 160
+		if not lcdc & 0x80:
+			self.back[ofs:ofs + 160] = BLANK_LINE
+			return
+		if lcdc & 0x01:
+			row = self.bg_row(lcdc & 0x08, lcdc, (ly + io[0x42]) & 0xFF)
+			scx = io[0x43]
+			raw = (row[scx:] + row[:scx])[:160]
+			wx = io[0x4B] - 7
+			if lcdc & 0x20 and io[0x4A] <= ly and wx < 160:
+				win = self.bg_row(lcdc & 0x40, lcdc, self.window_line & 0xFF)
+				if wx < 0:
+					win = win[-wx:]
+					wx = 0
+				raw = raw[:wx] + win[:160 - wx]
+				self.window_line += 1
+		else:
+			raw = BLANK_LINE
+		line = bytearray(raw.translate(PALETTE_TABLES[io[0x47]]))
+		if lcdc & 0x02:
+			self.draw_sprites(ly, lcdc, line, raw)
+		self.back[ofs:ofs + 160] = line
+
+	def draw_sprites(self, ly, lcdc, line, raw):
+		io = self.bus.ioreg.data
+		oam = self.oam
+		h = 16 if lcdc & 0x04 else 8
+		found = []
+		for i in range(0, 0xA0, 4):
+			y = oam[i] - 16
+			if y <= ly < y + h:
+				found.append((oam[i + 1], i))
+				if len(found) == 10:
+					break
+		# paint lowest priority first, smaller x (then OAM index) wins
+		found.sort(reverse=True)
+		serial = self.bus.vram.tile_serial
+		for x, i in found:
+			x -= 8
+			attr = oam[i + 3]
+			row = ly - (oam[i] - 16)
+			if attr & 0x40:
+				row = h - 1 - row
+			t = oam[i + 2]
+			if h == 16:
+				t = (t & 0xFE) | (row >> 3)
+			if serial[t] > self.tile_stamp[t]:
+				self.decode_tile(t)
+			px = self.tile_rows[t][row & 7]
+			if attr & 0x20:
+				px = px[::-1]
+			pal = PALETTE_TABLES[io[0x49] if attr & 0x10 else io[0x48]]
+			behind = attr & 0x80
+			for k in range(8):
+				c = px[k]
+				sx = x + k
+				if c and 0 <= sx < 160 and not (behind and raw[sx]):
+					line[sx] = pal[c]
+
+BTN_RIGHT  = 0x01
+BTN_LEFT   = 0x02
+BTN_UP     = 0x04
+BTN_DOWN   = 0x08
+BTN_A      = 0x10
+BTN_B      = 0x20
+BTN_SELECT = 0x40
+BTN_START  = 0x80
+
+# interrupt request/enable bits, in priority order
+INT_VBLANK = 0x01
+INT_STAT   = 0x02
+INT_TIMER  = 0x04
+INT_SERIAL = 0x08
+INT_JOYPAD = 0x10
+# M-cycles to shift out a serial byte on the internal clock
+SERIAL_CYCLES = 1024
 class IOReg:
 	def __init__(self):
 		self.bus = None
 
-		self.data = [0x00] * 0x80
+		# FF00-FF7F as stored, hooked registers may read back differently
+		self.data = bytearray(0x80)
+		self.view = memoryview(self.data).toreadonly()
+		# pressed buttons, see BTN_*
+		self.buttons = 0x00
+		# interrupt enable, FFFF
+		self.ie = 0x00
+		# serial transfer in progress
+		self.serial_event = None
+
+		# registers that are more than plain storage, address -> handler
+		self.read_hooks = {
+			0xFF00: self.read_joypad,
+			0xFF0F: self.read_if,
+			0xFF44: self.read_ly,
+		}
+		self.write_hooks = {
+			0xFF02: self.write_sc,
+			0xFF0F: self.write_if,
+		}
 
 	def write_at(self, adr, val):
 		if inrng(adr, 0x0000, 0xFEFF):
 			pass
 		elif inrng(adr, 0xFF00, 0xFF7F):
-			self.data[adr - 0xFF00] = val
-		elif inrng(adr, 0xFF80, 0xFFFF):
+			fn = self.write_hooks.get(adr)
+			if not fn is None:
+				fn(val)
+			else:
+				self.data[adr - 0xFF00] = val
+		elif inrng(adr, 0xFF80, 0xFFFE):
 			pass
+		elif adr == 0xFFFF:
+			self.ie = val
+			self.bus.sync()
 
 	def read_at(self, adr):
 		if inrng(adr, 0x0000, 0xFEFF):
 			return None
 		elif inrng(adr, 0xFF00, 0xFF7F):
+			fn = self.read_hooks.get(adr)
+			if not fn is None:
+				return fn()
 			return self.data[adr - 0xFF00]
-		elif inrng(adr, 0xFF80, 0xFFFF):
+		elif inrng(adr, 0xFF80, 0xFFFE):
 			return None
+		elif adr == 0xFFFF:
+			return self.ie
+
+	def read_joypad(self):
+		sel = self.data[0x00] & 0x30
+		val = 0x0F
+		if not sel & 0x10:
+			val &= ~self.buttons
+		if not sel & 0x20:
+			val &= ~(self.buttons >> 4)
+		return 0xC0 | sel | (val & 0x0F)
+
+	def read_ly(self):
+		return self.bus.get_ly()
+
+	def set_buttons(self, buttons):
+		if buttons & ~self.buttons:
+			self.bus.request_interrupt(INT_JOYPAD)
+		self.buttons = buttons
+
+	def read_if(self):
+		return 0xE0 | self.data[0x0F]
+
+	def write_if(self, val):
+		self.data[0x0F] = val & 0x1F
+		self.bus.sync()
+
+	def write_sc(self, val):
+		self.data[0x02] = val
+		if val & 0x81 == 0x81:
+			self.restore_serial(SERIAL_CYCLES)
+
+	def serial_left(self):
+		# cycles until the transfer in progress ends, 0 if there is none
+		if self.serial_event is None:
+			return 0
+		return self.serial_event[0] - self.bus.cycles
+
+	def restore_serial(self, left):
+		bus = self.bus
+		if not self.serial_event is None:
+			bus.cancel(self.serial_event)
+			self.serial_event = None
+		if left:
+			self.serial_event = bus.schedule(bus.cycles + left, self.end_transfer)
+
+	def end_transfer(self, cycle):
+		self.serial_event = None
+		# nothing on the other end of the link, so all ones come back
+		self.data[0x01] = 0xFF
+		self.data[0x02] &= 0x7F
+		self.bus.request_interrupt(INT_SERIAL)
+
+# M-cycles per TIMA tick, by the low bits of TAC
+TIMER_PERIODS = (256, 4, 16, 64)
+
+class Timer:
+	# DIV and TIMA are worked out from the cycle counter when read, the only
+	# event is the next TIMA overflow
+	def __init__(self):
+		self.bus = None
+
+		# cycle the internal counter behind DIV was last reset at
+		self.div_base = 0
+		# TIMA was <tima> at tick <ticks> (counted from div_base)
+		self.tima = 0
+		self.ticks = 0
+		self.overflow_event = None
+
+	def start(self):
+		bus = self.bus
+		io = bus.ioreg
+		io.read_hooks[0xFF04] = self.read_div
+		io.read_hooks[0xFF05] = self.read_tima
+		io.write_hooks[0xFF04] = self.write_div
+		io.write_hooks[0xFF05] = self.write_tima
+		io.write_hooks[0xFF07] = self.write_tac
+		bus.volatile[0xFF04] = self.div_changes
+		bus.volatile[0xFF05] = self.tima_changes
+		self.div_base = bus.cycles
+
+	def period(self):
+		return TIMER_PERIODS[self.bus.ioreg.data[0x07] & 3]
+
+	def enabled(self):
+		return self.bus.ioreg.data[0x07] & 0x04
+
+	def read_div(self):
+		return ((self.bus.cycles - self.div_base) >> 6) & 0xFF
+
+	def read_tima(self):
+		if not self.enabled():
+			return self.tima
+		ticks = (self.bus.cycles - self.div_base) // self.period()
+		return (self.tima + ticks - self.ticks) & 0xFF
+
+	def write_div(self, val):
+		self.tima = self.read_tima()
+		self.div_base = self.bus.cycles
+		self.reschedule()
+
+	def write_tima(self, val):
+		self.tima = val
+		self.reschedule()
+
+	def write_tac(self, val):
+		self.tima = self.read_tima()
+		self.bus.ioreg.data[0x07] = val
+		self.reschedule()
+
+	def reschedule(self):
+		# counts on from <tima> as of now
+		bus = self.bus
+		if not self.overflow_event is None:
+			bus.cancel(self.overflow_event)
+			self.overflow_event = None
+		if self.enabled():
+			period = self.period()
+			self.ticks = (bus.cycles - self.div_base) // period
+			cycle = self.div_base + (self.ticks + 0x100 - self.tima) * period
+			self.overflow_event = bus.schedule(cycle, self.overflow)
+
+	def overflow(self, cycle):
+		bus = self.bus
+		period = self.period()
+		self.tima = bus.ioreg.data[0x06]
+		self.ticks = (cycle - self.div_base) // period
+		cycle = self.div_base + (self.ticks + 0x100 - self.tima) * period
+		self.overflow_event = bus.schedule(cycle, self.overflow)
+		bus.request_interrupt(INT_TIMER)
+
+	def div_changes(self):
+		return self.div_base + ((((self.bus.cycles - self.div_base) >> 6) + 1) << 6)
+
+	def tima_changes(self):
+		if not self.enabled():
+			return NO_EVENT
+		period = self.period()
+		return self.div_base + ((self.bus.cycles - self.div_base) // period + 1) * period
+
+	def restore(self, counter, tima):
+		# <counter> is the low bits of the internal counter, see save_state
+		self.div_base = self.bus.cycles - counter
+		self.tima = tima
+		self.reschedule()
 
 class HRAM:
 	def __init__(self):
 		self.bus = None
 
-		self.hram = [0x00] * 0x7F
+		self.hram = bytearray(0x7F)
+		self.view = memoryview(self.hram).toreadonly()
 
 	def write_at(self, adr, val):
 		if inrng(adr, 0x0000, 0xFF7F):
@@ -594,12 +1311,23 @@ class HRAM:
 		elif inrng(adr, 0xFFFF, 0xFFFF):
 			return None
 
+	def read_span(self, adr):
+		if inrng(adr, 0xFF80, 0xFFFE):
+			return self.hram, adr - 0xFF80, 0xFFFF - adr
+
+	def write_span(self, adr, n):
+		return self.read_span(adr)
+
 class WRAM:
 	def __init__(self):
 		self.bus = None
 
-		self.wram0 = [0x00] * 0x1000
-		self.wram1 = [0x00] * 0x1000
+		# C000-DFFF, <view> is a read-only view of all of it
+		self.data = bytearray(0x2000)
+		self.view = memoryview(self.data).toreadonly()
+		mem = memoryview(self.data)
+		self.wram0 = mem[0x0000:0x1000]
+		self.wram1 = mem[0x1000:0x2000]
 
 	def write_at(self, adr, val):
 		if inrng(adr, 0x0000, 0xBFFF):
@@ -629,7 +1357,84 @@ class WRAM:
 		elif inrng(adr, 0xFE00, 0xFFFF):
 			return None
 
+	def read_span(self, adr):
+		if inrng(adr, 0xC000, 0xDFFF):
+			return self.data, adr - 0xC000, 0xE000 - adr
+		elif inrng(adr, 0xE000, 0xFDFF):
+			return self.data, adr - 0xE000, 0xFE00 - adr
+
+	def write_span(self, adr, n):
+		return self.read_span(adr)
+
 USE_BOOTROM = False
+FRAME_CYCLES = 17476
+LINE_CYCLES = FRAME_CYCLES / 154
+NO_EVENT = 1 << 62
+# first frame cycle of each line after the one indexed, matching get_ly
+LINE_END = []
+for ly in range(1, 155):
+	fc = int(ly * FRAME_CYCLES / 154)
+	while int(fc / LINE_CYCLES) < ly:
+		fc += 1
+	while int((fc - 1) / LINE_CYCLES) >= ly:
+		fc -= 1
+	LINE_END.append(fc)
+LINE_START = [0] + LINE_END[:-1]
+
+# ALU lookup tables, each entry is (result, F) with every flag worked out.
+# The carry going in is bit 4 of F, shifted to bit 8 of the index for
+# inc/dec and the shifts, to bit 16 for adc/sbc (add/sub/cp are adc/sbc
+# with no carry). DAA takes N, H and C from F as bits 10-8.
+ALU_PAIRS = {}
+def alu_pair(res, f):
+	# one shared tuple per distinct entry
+	key = (res & 0xFF, f | (0x80 if res & 0xFF == 0 else 0))
+	return ALU_PAIRS.setdefault(key, key)
+
+# adc/sbc entries by unmasked result and half carry, then spread out
+ADC_OUT = [[alu_pair(s, h << 5 | (0x10 if s > 0xFF else 0)) for h in range(2)] for s in range(0x200)]
+SBC_OUT = [[alu_pair(s, 0x40 | h << 5 | (0x10 if s < 0 else 0)) for h in range(2)] for s in range(-0x100, 0x100)]
+ALU_ADC = []
+ALU_SBC = []
+for c in range(2):
+	for a in range(0x100):
+		lo = (a & 0xF) + c
+		ALU_ADC += [ADC_OUT[a + b + c][lo + (b & 0xF) > 0xF] for b in range(0x100)]
+		lo = (a & 0xF) - c
+		ALU_SBC += [SBC_OUT[a - b - c + 0x100][lo - (b & 0xF) < 0] for b in range(0x100)]
+ALU_INC = [alu_pair(v + 1, (0x20 if v & 0xF == 0xF else 0) | c << 4) for c in range(2) for v in range(0x100)]
+ALU_DEC = [alu_pair(v - 1, 0x40 | (0x20 if v & 0xF == 0 else 0) | c << 4) for c in range(2) for v in range(0x100)]
+# and/or/xor: F from the result alone
+ALU_AND_F = [0xA0] + [0x20] * 0xFF
+ALU_OR_F = [0x80] + [0x00] * 0xFF
+
+ALU_RLC = [alu_pair(v << 1 | v >> 7, (v >> 7) << 4) for c in range(2) for v in range(0x100)]
+ALU_RRC = [alu_pair(v >> 1 | v << 7, (v & 1) << 4) for c in range(2) for v in range(0x100)]
+ALU_RL = [alu_pair(v << 1 | c, (v >> 7) << 4) for c in range(2) for v in range(0x100)]
+ALU_RR = [alu_pair(v >> 1 | c << 7, (v & 1) << 4) for c in range(2) for v in range(0x100)]
+ALU_SLA = [alu_pair(v << 1, (v >> 7) << 4) for c in range(2) for v in range(0x100)]
+ALU_SRA = [alu_pair(v >> 1 | v & 0x80, (v & 1) << 4) for c in range(2) for v in range(0x100)]
+ALU_SWAP = [alu_pair(v << 4 | v >> 4, 0) for c in range(2) for v in range(0x100)]
+ALU_SRL = [alu_pair(v >> 1, (v & 1) << 4) for c in range(2) for v in range(0x100)]
+
+def daa(i):
+	a = i & 0xFF
+	n = i & 0x400
+	h = i & 0x200
+	c = i & 0x100
+	if not n:
+		if c or a > 0x99:
+			a += 0x60
+			c = 1
+		if h or (a & 0xF) > 0x9:
+			a += 0x06
+	else:
+		if c:
+			a -= 0x60
+		if h:
+			a -= 0x06
+	return alu_pair(a, (0x40 if n else 0) | (0x10 if c else 0))
+ALU_DAA = [daa(i) for i in range(0x800)]
 class CPU:
 	def __init__(self):
 		self.bus = None
@@ -657,6 +1462,12 @@ class CPU:
 			self.reg_sp = 0xFFFE
 			self.reg_pc = 0x00FE
 
+		# set by halt, cleared once an enabled interrupt is requested
+		self.halted = False
+		# interrupt master enable, ei sets it after the next instruction
+		self.ime = False
+		self.ime_delay = False
+
 	def stack_push(self, val):
 		self.reg_sp = (self.reg_sp - 1) % 0x10000
 		self.bus.write_at(self.reg_sp, val >> 8)
@@ -747,349 +1558,1374 @@ class CPU:
 		return None
 
 	def run_opcode(self, opcode, arg):
-		if opcode == 0x00:   # nop
-			pass
-		elif opcode == 0x01: # ld bc, arg
-			self.reg_bc = arg
-		elif opcode == 0x02: # ld [bc], a
-			self.bus.write_at(self.reg_bc, self.reg_a)
-		elif opcode == 0x03: # inc bc
-			self.reg_bc = (self.reg_bc + 1) % 0x10000
-		elif opcode == 0x04: # inc b
-			self.reg_b = (self.reg_b + 1) % 0x100
-			self.flg_z = self.reg_b == 0
-			self.flg_n = False
-			self.flg_h = (self.reg_b & 0xF) == 0x0
-		elif opcode == 0x05: # dec b
-			self.reg_b = (self.reg_b - 1) % 0x100
-			self.flg_z = self.reg_b == 0
-			self.flg_n = True
-			self.flg_h = (self.reg_b & 0xF) == 0xF
-		elif opcode == 0x06: # ld b, arg
-			self.reg_b = arg
-		elif opcode == 0x07: # rlca
-			self.flg_c = bool(self.reg_a & 0x80)
-			self.reg_a = (self.reg_a << 1) & 0xFF
-			self.flg_n = False
-			self.flg_h = False
-			self.flg_z = self.reg_a == 0
-		elif opcode == 0x08: # ld [arg], sp
-			self.bus.write_at(arg, self.reg_sp & 0xFF)
-			self.bus.write_at(arg + 1, self.reg_sp >> 8)
-		elif opcode == 0x0C: # inc c
-			self.reg_c = (self.reg_c + 1) % 0x100
-			self.flg_z = self.reg_c == 0
-			self.flg_n = False
-			self.flg_h = (self.reg_c & 0xF) == 0x0
-		elif opcode == 0x0D: # dec c
-			self.reg_c = (self.reg_c - 1) % 0x100
-			self.flg_z = self.reg_c == 0
-			self.flg_n = True
-			self.flg_h = (self.reg_c & 0xF) == 0xF
-		elif opcode == 0x0E: # ld c, arg
-			self.reg_c = arg
-		elif opcode == 0x11: # ld de, arg
-			self.reg_de = arg
-		elif opcode == 0x13: # inc de
-			self.reg_de = (self.reg_de + 1) % 0x10000
-		elif opcode == 0x15: # dec d
-			self.reg_d = (self.reg_d - 1) % 0x100
-			self.flg_z = self.reg_d == 0
-			self.flg_n = True
-			self.flg_h = (self.reg_d & 0xF) == 0xF
-		elif opcode == 0x16: # ld d, arg
-			self.reg_d = arg
-		elif opcode == 0x17: # rla
-			new_c = self.reg_a & 0x80
-			self.reg_a <<= 1
-			self.reg_a &= 0xFF
-			if self.flg_c:
-				self.reg_a |= 0x1
-			self.flg_c = bool(new_c)
-			self.flg_z = self.reg_a == 0
-			self.flg_n = False
-			self.flg_h = False
-		elif opcode == 0x18: # jr pc + arg
+		return OP_TABLE[opcode](self, arg) or 0
+
+	def run_opcode_cb(self, opcode):
+		CB_TABLE[opcode](self)
+		return CB_OPCODES[opcode]
+
+	def op_00(self, arg): # nop
+		pass
+
+	def op_01(self, arg): # ld bc, arg
+		self.reg_bc = arg
+
+	def op_02(self, arg): # ld [bc], a
+		self.bus.write_at(self.reg_bc, self.reg_a)
+
+	def op_03(self, arg): # inc bc
+		self.reg_bc = (self.reg_bc + 1) % 0x10000
+
+	def op_04(self, arg): # inc b
+		self.reg_b, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def op_05(self, arg): # dec b
+		self.reg_b, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def op_06(self, arg): # ld b, arg
+		self.reg_b = arg
+
+	def op_07(self, arg): # rlca
+		self.reg_a, f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_a]
+		# unlike the CB versions, z is always cleared
+		self.reg_f = f & 0x10
+
+	def op_08(self, arg): # ld [arg], sp
+		self.bus.write_at(arg, self.reg_sp & 0xFF)
+		self.bus.write_at(arg + 1, self.reg_sp >> 8)
+
+	def op_0C(self, arg): # inc c
+		self.reg_c, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def op_0D(self, arg): # dec c
+		self.reg_c, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def op_0E(self, arg): # ld c, arg
+		self.reg_c = arg
+
+	def op_0F(self, arg): # rrca
+		self.reg_a, f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_a]
+		self.reg_f = f & 0x10
+
+	def op_11(self, arg): # ld de, arg
+		self.reg_de = arg
+
+	def op_13(self, arg): # inc de
+		self.reg_de = (self.reg_de + 1) % 0x10000
+
+	def op_14(self, arg): # inc d
+		self.reg_d, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def op_15(self, arg): # dec d
+		self.reg_d, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def op_16(self, arg): # ld d, arg
+		self.reg_d = arg
+
+	def op_17(self, arg): # rla
+		self.reg_a, f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_a]
+		self.reg_f = f & 0x10
+
+	def op_18(self, arg): # jr pc + arg
+		if arg > 0x7F:
+			arg = arg - 0x100
+		self.reg_pc += arg
+
+	def op_1A(self, arg): # ld a, [de]
+		self.reg_a = self.bus.read_at(self.reg_de)
+
+	def op_1C(self, arg): # inc e
+		self.reg_e, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def op_1D(self, arg): # dec e
+		self.reg_e, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def op_1E(self, arg): # ld e, arg
+		self.reg_e = arg
+
+	def op_1F(self, arg): # rra
+		self.reg_a, f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_a]
+		self.reg_f = f & 0x10
+
+	def op_20(self, arg): # jr nz, pc + arg
+		if not self.flg_z:
 			if arg > 0x7F:
 				arg = arg - 0x100
 			self.reg_pc += arg
-		elif opcode == 0x1A: # ld a, [de]
-			self.reg_a = self.bus.read_at(self.reg_de)
-		elif opcode == 0x1D: # dec e
-			self.reg_e = (self.reg_e - 1) % 0x100
-			self.flg_z = self.reg_e == 0
-			self.flg_n = True
-			self.flg_h = (self.reg_e & 0xF) == 0xF
-		elif opcode == 0x1E: # ld e, arg
-			self.reg_e = arg
-		elif opcode == 0x20: # jr nz, pc + arg
-			if not self.flg_z:
-				if arg > 0x7F:
-					arg = arg - 0x100
-				self.reg_pc += arg
-				return 1
-		elif opcode == 0x21: # ld hl, arg
-			self.reg_hl = arg
-		elif opcode == 0x22: # ldi [hl], a
-			self.bus.write_at(self.reg_hl, self.reg_a)
-			self.reg_hl = (self.reg_hl + 1) % 0x10000
-		elif opcode == 0x23: # inc hl
-			self.reg_hl = (self.reg_hl + 1) % 0x10000
-		elif opcode == 0x24: # inc h
-			self.reg_h = (self.reg_h + 1) % 0x100
-			self.flg_z = self.reg_h == 0
-			self.flg_n = False
-			self.flg_h = (self.reg_h & 0xF) == 0x0
-		elif opcode == 0x28: # jr z, pc + arg
-			if self.flg_z:
-				if arg > 0x7F:
-					arg = arg - 0x100
-				self.reg_pc += arg
-				return 1
-		elif opcode == 0x2E: # ld l, arg
-			self.reg_l = arg
-		elif opcode == 0x31: # ld sp, arg
-			self.reg_sp = arg
-		elif opcode == 0x32: # ldd [hl], a
-			self.bus.write_at(self.reg_hl, self.reg_a)
-			self.reg_hl = (self.reg_hl - 1) % 0x10000
-		elif opcode == 0x36: # ld [hl], arg
-			self.bus.write_at(self.reg_hl, arg)
-		elif opcode == 0x3D: # dec a
-			self.reg_a = (self.reg_a - 1) % 0x100
-			self.flg_z = self.reg_a == 0
-			self.flg_n = True
-			self.flg_h = (self.reg_a & 0xF) == 0xF
-		elif opcode == 0x3E: # ld a, arg
-			self.reg_a = arg
-		elif opcode == 0x4F: # ld c, a
-			self.reg_c = self.reg_a
-		elif opcode == 0x57: # ld d, a
-			self.reg_d = self.reg_a
-		elif opcode == 0x67: # ld h, a
-			self.reg_h = self.reg_a
-		elif opcode == 0x77: # ld [hl], a
-			self.bus.write_at(self.reg_hl, self.reg_a)
-		elif opcode == 0x78: # ld a, b
-			self.reg_a = self.reg_b
-		elif opcode == 0x7B: # ld a, e
-			self.reg_a = self.reg_e
-		elif opcode == 0x7C: # ld a, h
-			self.reg_a = self.reg_h
-		elif opcode == 0x7D: # ld a, l
-			self.reg_a = self.reg_l
-		elif opcode == 0x86: # add [hl]
-			val = self.bus.read_at(self.reg_hl)
-			self.flg_z = self.reg_a + val == 0x100
-			self.flg_n = False
-			self.flg_h = (self.reg_a & 0xF) + (val & 0xF) > 0xF
-			self.flg_c = self.reg_a + val > 0xFF
-			self.reg_a = (self.reg_a + val) % 0x100
-		elif opcode == 0x90: # sub b
-			self.flg_z = self.reg_a == self.reg_b
-			self.flg_n = True
-			self.flg_h = (self.reg_a & 0xF) < (self.reg_b & 0xF)
-			self.flg_c = self.reg_a < self.reg_b
-			self.reg_a = (self.reg_a - self.reg_b) % 0x100
-		elif opcode == 0xBE: # cp [hl]
-			val = self.bus.read_at(self.reg_hl)
-			self.flg_z = self.reg_a == val
-			self.flg_n = True
-			self.flg_h = (self.reg_a & 0xF) < (val & 0xF)
-			self.flg_c = self.reg_a < val
-		elif opcode == 0xC1: # pop bc
-			self.reg_bc = self.stack_pop()
-		elif opcode == 0xC3: # jp arg
-			self.reg_pc = arg
-		elif opcode == 0xC5: # push bc
-			self.stack_push(self.reg_bc)
-		elif opcode == 0xC9: # ret
-			self.reg_pc = self.stack_pop()
-		elif opcode == 0xCD: # call arg
-			self.stack_push(self.reg_pc)
-			self.reg_pc = arg
-		elif opcode == 0xAF: # xor a
-			self.reg_a = 0
-			self.flg_z = False
-			self.flg_n = False
-			self.flg_h = False
-			self.flg_c = False
-		elif opcode == 0xE0: # ldh [$FF00+arg], a
-			adr = 0xFF00 + arg
-			self.bus.write_at(adr, self.reg_a)
-		elif opcode == 0xE2: # ldh [c], a
-			adr = 0xFF00 + self.reg_c
-			self.bus.write_at(adr, self.reg_a)
-		elif opcode == 0xEA: # ld [arg], a
-			self.bus.write_at(arg, self.reg_a)
-		elif opcode == 0xF0: # ldh a, [$FF00+arg]
-			adr = 0xFF00 + arg
-			self.reg_a = self.bus.read_at(adr)
-		elif opcode == 0xF3: # di
-			pass
-		elif opcode == 0xFE: # cp arg
-			self.flg_z = self.reg_a == arg
-			self.flg_n = True
-			self.flg_h = (self.reg_a & 0xF) < (arg & 0xF)
-			self.flg_c = self.reg_a < arg
-		else:
-			raise Exception(f'ERROR: unknown opcode :: ${opcode:0>2X}')
-		return 0
+			return 1
 
-	def run_opcode_cb(self, opcode):
-		if opcode == 0x11:   # rl c
-			new_c = self.reg_c & 0x80
-			self.reg_c <<= 1
-			self.reg_c &= 0xFF
-			if self.flg_c:
-				self.reg_c |= 0x1
-			self.flg_c = bool(new_c)
-			self.flg_z = self.reg_c == 0
-			self.flg_n = False
-			self.flg_h = False
-			return 'rl c'
-		elif opcode == 0x7C: # bit 7, h
-			self.flg_z = not bool(self.reg_h & 0x80)
-			self.flg_n = False
-			self.flg_h = True
-			return 'bit 7, h'
-		else:
-			raise Exception(f'ERROR: unknown $CB opcode :: ${opcode:0>2X}')
+	def op_21(self, arg): # ld hl, arg
+		self.reg_hl = arg
+
+	def op_22(self, arg): # ldi [hl], a
+		self.bus.write_at(self.reg_hl, self.reg_a)
+		self.reg_hl = (self.reg_hl + 1) % 0x10000
+
+	def op_23(self, arg): # inc hl
+		self.reg_hl = (self.reg_hl + 1) % 0x10000
+
+	def op_24(self, arg): # inc h
+		self.reg_h, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def op_25(self, arg): # dec h
+		self.reg_h, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def op_27(self, arg): # daa
+		self.reg_a, self.reg_f = ALU_DAA[(self.reg_f & 0x70) << 4 | self.reg_a]
+
+	def op_28(self, arg): # jr z, pc + arg
+		if self.flg_z:
+			if arg > 0x7F:
+				arg = arg - 0x100
+			self.reg_pc += arg
+			return 1
+
+	def op_2C(self, arg): # inc l
+		self.reg_l, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def op_2D(self, arg): # dec l
+		self.reg_l, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def op_2E(self, arg): # ld l, arg
+		self.reg_l = arg
+
+	def op_31(self, arg): # ld sp, arg
+		self.reg_sp = arg
+
+	def op_32(self, arg): # ldd [hl], a
+		self.bus.write_at(self.reg_hl, self.reg_a)
+		self.reg_hl = (self.reg_hl - 1) % 0x10000
+
+	def op_34(self, arg): # inc [hl]
+		val, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def op_35(self, arg): # dec [hl]
+		val, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def op_36(self, arg): # ld [hl], arg
+		self.bus.write_at(self.reg_hl, arg)
+
+	def op_3C(self, arg): # inc a
+		self.reg_a, self.reg_f = ALU_INC[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def op_3D(self, arg): # dec a
+		self.reg_a, self.reg_f = ALU_DEC[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def op_3E(self, arg): # ld a, arg
+		self.reg_a = arg
+
+	def op_4F(self, arg): # ld c, a
+		self.reg_c = self.reg_a
+
+	def op_57(self, arg): # ld d, a
+		self.reg_d = self.reg_a
+
+	def op_67(self, arg): # ld h, a
+		self.reg_h = self.reg_a
+
+	def op_76(self, arg): # halt
+		if not self.bus.interrupts_pending():
+			self.halted = True
+
+	def op_77(self, arg): # ld [hl], a
+		self.bus.write_at(self.reg_hl, self.reg_a)
+
+	def op_78(self, arg): # ld a, b
+		self.reg_a = self.reg_b
+
+	def op_7B(self, arg): # ld a, e
+		self.reg_a = self.reg_e
+
+	def op_7C(self, arg): # ld a, h
+		self.reg_a = self.reg_h
+
+	def op_7D(self, arg): # ld a, l
+		self.reg_a = self.reg_l
+
+	def op_80(self, arg): # add b
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_b]
+
+	def op_81(self, arg): # add c
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_c]
+
+	def op_82(self, arg): # add d
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_d]
+
+	def op_83(self, arg): # add e
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_e]
+
+	def op_84(self, arg): # add h
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_h]
+
+	def op_85(self, arg): # add l
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_l]
+
+	def op_86(self, arg): # add [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | val]
+
+	def op_87(self, arg): # add a
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | self.reg_a]
+
+	def op_88(self, arg): # adc b
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_b]
+
+	def op_89(self, arg): # adc c
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_c]
+
+	def op_8A(self, arg): # adc d
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_d]
+
+	def op_8B(self, arg): # adc e
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_e]
+
+	def op_8C(self, arg): # adc h
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_h]
+
+	def op_8D(self, arg): # adc l
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_l]
+
+	def op_8E(self, arg): # adc [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | val]
+
+	def op_8F(self, arg): # adc a
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_a]
+
+	def op_90(self, arg): # sub b
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_b]
+
+	def op_91(self, arg): # sub c
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_c]
+
+	def op_92(self, arg): # sub d
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_d]
+
+	def op_93(self, arg): # sub e
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_e]
+
+	def op_94(self, arg): # sub h
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_h]
+
+	def op_95(self, arg): # sub l
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_l]
+
+	def op_96(self, arg): # sub [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | val]
+
+	def op_97(self, arg): # sub a
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_a]
+
+	def op_98(self, arg): # sbc b
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_b]
+
+	def op_99(self, arg): # sbc c
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_c]
+
+	def op_9A(self, arg): # sbc d
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_d]
+
+	def op_9B(self, arg): # sbc e
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_e]
+
+	def op_9C(self, arg): # sbc h
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_h]
+
+	def op_9D(self, arg): # sbc l
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_l]
+
+	def op_9E(self, arg): # sbc [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | val]
+
+	def op_9F(self, arg): # sbc a
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | self.reg_a]
+
+	def op_A0(self, arg): # and b
+		self.reg_a &= self.reg_b
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A1(self, arg): # and c
+		self.reg_a &= self.reg_c
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A2(self, arg): # and d
+		self.reg_a &= self.reg_d
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A3(self, arg): # and e
+		self.reg_a &= self.reg_e
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A4(self, arg): # and h
+		self.reg_a &= self.reg_h
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A5(self, arg): # and l
+		self.reg_a &= self.reg_l
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A6(self, arg): # and [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a &= val
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A7(self, arg): # and a
+		self.reg_a &= self.reg_a
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_A8(self, arg): # xor b
+		self.reg_a ^= self.reg_b
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_A9(self, arg): # xor c
+		self.reg_a ^= self.reg_c
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_AA(self, arg): # xor d
+		self.reg_a ^= self.reg_d
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_AB(self, arg): # xor e
+		self.reg_a ^= self.reg_e
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_AC(self, arg): # xor h
+		self.reg_a ^= self.reg_h
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_AD(self, arg): # xor l
+		self.reg_a ^= self.reg_l
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_AE(self, arg): # xor [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a ^= val
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_AF(self, arg): # xor a
+		self.reg_a ^= self.reg_a
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B0(self, arg): # or b
+		self.reg_a |= self.reg_b
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B1(self, arg): # or c
+		self.reg_a |= self.reg_c
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B2(self, arg): # or d
+		self.reg_a |= self.reg_d
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B3(self, arg): # or e
+		self.reg_a |= self.reg_e
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B4(self, arg): # or h
+		self.reg_a |= self.reg_h
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B5(self, arg): # or l
+		self.reg_a |= self.reg_l
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B6(self, arg): # or [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_a |= val
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B7(self, arg): # or a
+		self.reg_a |= self.reg_a
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_B8(self, arg): # cp b
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_b][1]
+
+	def op_B9(self, arg): # cp c
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_c][1]
+
+	def op_BA(self, arg): # cp d
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_d][1]
+
+	def op_BB(self, arg): # cp e
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_e][1]
+
+	def op_BC(self, arg): # cp h
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_h][1]
+
+	def op_BD(self, arg): # cp l
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_l][1]
+
+	def op_BE(self, arg): # cp [hl]
+		val = self.bus.read_at(self.reg_hl)
+		self.reg_f = ALU_SBC[self.reg_a << 8 | val][1]
+
+	def op_BF(self, arg): # cp a
+		self.reg_f = ALU_SBC[self.reg_a << 8 | self.reg_a][1]
+
+	def op_C1(self, arg): # pop bc
+		self.reg_bc = self.stack_pop()
+
+	def op_C3(self, arg): # jp arg
+		self.reg_pc = arg
+
+	def op_C5(self, arg): # push bc
+		self.stack_push(self.reg_bc)
+
+	def op_C6(self, arg): # add arg
+		self.reg_a, self.reg_f = ALU_ADC[self.reg_a << 8 | arg]
+
+	def op_C9(self, arg): # ret
+		self.reg_pc = self.stack_pop()
+
+	def op_CD(self, arg): # call arg
+		self.stack_push(self.reg_pc)
+		self.reg_pc = arg
+
+	def op_CE(self, arg): # adc arg
+		self.reg_a, self.reg_f = ALU_ADC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | arg]
+
+	def op_D6(self, arg): # sub arg
+		self.reg_a, self.reg_f = ALU_SBC[self.reg_a << 8 | arg]
+
+	def op_D9(self, arg): # reti
+		self.reg_pc = self.stack_pop()
+		self.ime = True
+		self.bus.sync()
+
+	def op_DE(self, arg): # sbc arg
+		self.reg_a, self.reg_f = ALU_SBC[(self.reg_f & 0x10) << 12 | self.reg_a << 8 | arg]
+
+	def op_E0(self, arg): # ldh [$FF00+arg], a
+		adr = 0xFF00 + arg
+		self.bus.write_at(adr, self.reg_a)
+
+	def op_E2(self, arg): # ldh [c], a
+		adr = 0xFF00 + self.reg_c
+		self.bus.write_at(adr, self.reg_a)
+
+	def op_E6(self, arg): # and arg
+		self.reg_a &= arg
+		self.reg_f = ALU_AND_F[self.reg_a]
+
+	def op_EA(self, arg): # ld [arg], a
+		self.bus.write_at(arg, self.reg_a)
+
+	def op_EE(self, arg): # xor arg
+		self.reg_a ^= arg
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_F0(self, arg): # ldh a, [$FF00+arg]
+		adr = 0xFF00 + arg
+		self.reg_a = self.bus.read_at(adr)
+
+	def op_F3(self, arg): # di
+		self.ime = False
+		self.ime_delay = False
+
+	def op_F6(self, arg): # or arg
+		self.reg_a |= arg
+		self.reg_f = ALU_OR_F[self.reg_a]
+
+	def op_FB(self, arg): # ei
+		self.ime_delay = True
+		self.bus.sync()
+
+	def op_FE(self, arg): # cp arg
+		self.reg_f = ALU_SBC[self.reg_a << 8 | arg][1]
+
+	def cb_00(self): # rlc b
+		self.reg_b, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_01(self): # rlc c
+		self.reg_c, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_02(self): # rlc d
+		self.reg_d, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_03(self): # rlc e
+		self.reg_e, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_04(self): # rlc h
+		self.reg_h, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_05(self): # rlc l
+		self.reg_l, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_06(self): # rlc [hl]
+		val, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_07(self): # rlc a
+		self.reg_a, self.reg_f = ALU_RLC[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_08(self): # rrc b
+		self.reg_b, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_09(self): # rrc c
+		self.reg_c, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_0A(self): # rrc d
+		self.reg_d, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_0B(self): # rrc e
+		self.reg_e, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_0C(self): # rrc h
+		self.reg_h, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_0D(self): # rrc l
+		self.reg_l, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_0E(self): # rrc [hl]
+		val, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_0F(self): # rrc a
+		self.reg_a, self.reg_f = ALU_RRC[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_10(self): # rl b
+		self.reg_b, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_11(self): # rl c
+		self.reg_c, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_12(self): # rl d
+		self.reg_d, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_13(self): # rl e
+		self.reg_e, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_14(self): # rl h
+		self.reg_h, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_15(self): # rl l
+		self.reg_l, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_16(self): # rl [hl]
+		val, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_17(self): # rl a
+		self.reg_a, self.reg_f = ALU_RL[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_18(self): # rr b
+		self.reg_b, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_19(self): # rr c
+		self.reg_c, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_1A(self): # rr d
+		self.reg_d, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_1B(self): # rr e
+		self.reg_e, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_1C(self): # rr h
+		self.reg_h, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_1D(self): # rr l
+		self.reg_l, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_1E(self): # rr [hl]
+		val, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_1F(self): # rr a
+		self.reg_a, self.reg_f = ALU_RR[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_20(self): # sla b
+		self.reg_b, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_21(self): # sla c
+		self.reg_c, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_22(self): # sla d
+		self.reg_d, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_23(self): # sla e
+		self.reg_e, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_24(self): # sla h
+		self.reg_h, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_25(self): # sla l
+		self.reg_l, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_26(self): # sla [hl]
+		val, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_27(self): # sla a
+		self.reg_a, self.reg_f = ALU_SLA[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_28(self): # sra b
+		self.reg_b, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_29(self): # sra c
+		self.reg_c, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_2A(self): # sra d
+		self.reg_d, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_2B(self): # sra e
+		self.reg_e, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_2C(self): # sra h
+		self.reg_h, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_2D(self): # sra l
+		self.reg_l, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_2E(self): # sra [hl]
+		val, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_2F(self): # sra a
+		self.reg_a, self.reg_f = ALU_SRA[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_30(self): # swap b
+		self.reg_b, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_31(self): # swap c
+		self.reg_c, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_32(self): # swap d
+		self.reg_d, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_33(self): # swap e
+		self.reg_e, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_34(self): # swap h
+		self.reg_h, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_35(self): # swap l
+		self.reg_l, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_36(self): # swap [hl]
+		val, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_37(self): # swap a
+		self.reg_a, self.reg_f = ALU_SWAP[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_38(self): # srl b
+		self.reg_b, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_b]
+
+	def cb_39(self): # srl c
+		self.reg_c, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_c]
+
+	def cb_3A(self): # srl d
+		self.reg_d, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_d]
+
+	def cb_3B(self): # srl e
+		self.reg_e, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_e]
+
+	def cb_3C(self): # srl h
+		self.reg_h, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_h]
+
+	def cb_3D(self): # srl l
+		self.reg_l, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_l]
+
+	def cb_3E(self): # srl [hl]
+		val, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.bus.read_at(self.reg_hl)]
+		self.bus.write_at(self.reg_hl, val)
+
+	def cb_3F(self): # srl a
+		self.reg_a, self.reg_f = ALU_SRL[(self.reg_f & 0x10) << 4 | self.reg_a]
+
+	def cb_7C(self): # bit 7, h
+		self.flg_z = not bool(self.reg_h & 0x80)
+		self.flg_n = False
+		self.flg_h = True
+
+def unknown_opcode(opcode):
+	def op(self, arg):
+		raise Exception(f'ERROR: unknown opcode :: ${opcode:0>2X}')
+	return op
+
+def unknown_opcode_cb(opcode):
+	def op(self):
+		raise Exception(f'ERROR: unknown $CB opcode :: ${opcode:0>2X}')
+	return op
+
+# dispatch tables, indexed by opcode
+OP_TABLE = [unknown_opcode(i) for i in range(0x100)]
+for i in OPCODES:
+	OP_TABLE[i] = getattr(CPU, f'op_{i:0>2X}', OP_TABLE[i])
+CB_TABLE = [unknown_opcode_cb(i) for i in range(0x100)]
+for i in CB_OPCODES:
+	CB_TABLE[i] = getattr(CPU, f'cb_{i:0>2X}', CB_TABLE[i])
+# operand length and base cycles per opcode, -1 marks an invalid opcode
+OP_NARGS = [-1] * 0x100
+OP_CYCLES = [0] * 0x100
+for i, (narg, cycles, _) in OPCODES.items():
+	OP_NARGS[i] = narg
+	OP_CYCLES[i] = cycles
+
+# block translation: CB handlers wrapped to the (cpu, arg) signature of
+# OP_TABLE, and the opcodes that may leave straight-line code
+CB_BLOCK_TABLE = [lambda cpu, arg, fn=fn: fn(cpu) for fn in CB_TABLE]
+BLOCK_END = {
+	i for i, (_, _, disasm) in OPCODES.items()
+	if disasm.split()[0] in ('jr', 'jp', 'call', 'ret', 'reti', 'rst', 'halt', 'stop', 'di', 'ei')
+}
+MAX_BLOCK = 64
+RAM_BANK = 0x10000 << 16
+
+# opcodes allowed in an idle loop: they write nothing but a and f. Mapped
+# to what they read from memory as (register, offset), the address being
+# the register's value plus offset, register None for a fixed address
+# from the operand, or None if they don't read memory.
+IDLE_OPS = {i: None for i in (0x00, 0x07, 0x0F, 0x17, 0x1F, 0x2F, 0x37, 0x3F, 0x3E)}
+for i in range(0x78, 0xC0):
+	IDLE_OPS[i] = ('reg_hl', 0) if i & 7 == 6 else None
+for i in range(0xC6, 0x100, 8):
+	IDLE_OPS[i] = None
+IDLE_OPS[0x0A] = ('reg_bc', 0)
+IDLE_OPS[0x1A] = ('reg_de', 0)
+IDLE_OPS[0xF2] = ('reg_c', 0xFF00)
+IDLE_OPS[0xF0] = (None, 0xFF00)
+IDLE_OPS[0xFA] = (None, 0)
+# branches that may close an idle loop, conditional or not
+IDLE_JR = (0x18, 0x20, 0x28, 0x30, 0x38)
+IDLE_JP = (0xC3, 0xC2, 0xCA, 0xD2, 0xDA)
 
 class BootROM:
+	def __init__(self, bus, fn='bootrom.gb'):
+		self.bus = bus
+		self.data = open(fn, 'rb').read()
+
+class BlockCache:
 	def __init__(self, bus):
 		self.bus = bus
-		self.data = open('bootrom.gb', 'rb').read()
+
+		# block key -> tuple of (next_pc, handler, arg, cycles, left)
+		self.blocks = {}
+		# RAM page -> keys of the blocks that read code from it
+		self.page_blocks = {}
+		# the same per address for HRAM, which shares its page with IO and
+		# the stack, so most writes there never touch code
+		self.hram_blocks = {}
+		# block key -> memory reads, for blocks that are idle loops
+		self.idle = {}
+		# ((key, a, f), cycles, stable until) when an idle loop last started
+		self.idle_last = None
+
+	def key(self, pc):
+		# (bank, pc) packed into an int, None where code is not cached
+		if pc < 0x8000:
+			rom = self.bus.rom
+			if rom is None or (pc < 0x100 and self.bus.bootrom_loaded):
+				return None
+			if pc < 0x4000:
+				return (rom.bank0_id << 16) | pc
+			return (rom.bankn_id << 16) | pc
+		if inrng(pc, 0xC000, 0xDFFF) or inrng(pc, 0xFF80, 0xFFFE):
+			return RAM_BANK | pc
+		return None
+
+	def region_end(self, pc):
+		if pc < 0x4000: return 0x4000
+		if pc < 0x8000: return 0x8000
+		if pc < 0xE000: return 0xE000
+		return 0xFFFF
+
+	def translate(self, pc, key):
+		bus = self.bus
+		start = pc
+		end = self.region_end(pc)
+		blk = []
+		# memory reads while this could still be an idle loop
+		reads = []
+		while len(blk) < MAX_BLOCK:
+			opcode = bus.read_at(pc)
+			narg = OP_NARGS[opcode]
+			if narg < 0 or pc + narg >= end:
+				break
+			if narg == 0:
+				arg = None
+			elif narg == 1:
+				arg = bus.read_at(pc + 1)
+			else:
+				arg = bus.read_at(pc + 1) | (bus.read_at(pc + 2) << 8)
+			if opcode == 0xCB:
+				fn = CB_BLOCK_TABLE[arg]
+				cycles = OP_CYCLES[0xCB]
+				if arg & 0b111 == 0b110:
+					cycles += 1
+			else:
+				fn = OP_TABLE[opcode]
+				cycles = OP_CYCLES[opcode]
+			pc += 1 + narg
+			blk.append([pc, fn, arg, cycles])
+			if not reads is None:
+				if opcode in IDLE_JR and (pc + signb(arg)) & 0xFFFF == start:
+					self.idle[key] = tuple(reads)
+				elif opcode in IDLE_JP and arg == start:
+					self.idle[key] = tuple(reads)
+				elif opcode == 0xCB and inrng(arg, 0x40, 0x7F):
+					# bit
+					if arg & 7 == 6:
+						reads.append(('reg_hl', 0))
+				elif opcode in IDLE_OPS:
+					src = IDLE_OPS[opcode]
+					if not src is None:
+						reads.append(src if src[0] else (None, src[1] + arg))
+				else:
+					reads = None
+			if opcode in BLOCK_END:
+				break
+		if not blk:
+			return None
+		# last field: instructions left after this one
+		blk = tuple(tuple(ins) + (len(blk) - i - 1,) for i, ins in enumerate(blk))
+		self.blocks[key] = blk
+		if key & RAM_BANK:
+			if start >= 0xFF00:
+				for adr in range(start, pc):
+					self.hram_blocks.setdefault(adr, []).append(key)
+				bus.code_pages[0xFF] = 1
+			else:
+				for pg in range(start >> 8, ((pc - 1) >> 8) + 1):
+					self.page_blocks.setdefault(pg, []).append(key)
+					bus.code_pages[pg] = 1
+		return blk
+
+	def clear(self):
+		for pg in self.page_blocks:
+			self.bus.code_pages[pg] = 0
+		self.bus.code_pages[0xFF] = 0
+		self.blocks = {}
+		self.page_blocks = {}
+		self.hram_blocks = {}
+		self.idle = {}
+		self.idle_last = None
+		self.bus.sync()
+
+	def invalidate(self, adr):
+		bus = self.bus
+		pg = adr >> 8
+		if pg == 0xFF:
+			keys = self.hram_blocks.pop(adr, None)
+			if keys is None:
+				# IO or stack, not code
+				return
+			for key in keys:
+				self.blocks.pop(key, None)
+				self.idle.pop(key, None)
+			if not self.hram_blocks:
+				bus.code_pages[pg] = 0
+		elif pg >= 0x80:
+			for key in self.page_blocks.pop(pg, ()):
+				self.blocks.pop(key, None)
+				self.idle.pop(key, None)
+			bus.code_pages[pg] = 0
+		# the running block may be stale now (or the ROM bank changed),
+		# stop it after this instruction
+		bus.sync()
+
+	def run(self):
+		# runs the block at pc, returns False if pc is not cacheable
+		bus = self.bus
+		cpu = bus.cpu
+		key = self.key(cpu.reg_pc)
+		if key is None:
+			return False
+		blk = self.blocks.get(key)
+		if blk is None:
+			blk = self.translate(cpu.reg_pc, key)
+			if blk is None:
+				return False
+		idle = None
+		if key in self.idle:
+			idle = self.skip_idle(key, blk)
+		self.idle_last = None
+		bus.instructions += len(blk)
+		for next_pc, fn, arg, cycles, left in blk:
+			cpu.reg_pc = next_pc
+			bus.cycles += cycles + (fn(cpu, arg) or 0)
+			if bus.cycles >= bus.next_event:
+				bus.instructions -= left
+				bus.run_events()
+				break
+		else:
+			# only an iteration that branched straight back to its own start
+			# counts towards the next one, e.g. not a wait routine that is
+			# called and returns
+			if not idle is None and cpu.reg_pc == key & 0xFFFF:
+				self.idle_last = idle
+		return True
+
+	def skip_idle(self, key, blk):
+		# the block is a loop that only reads memory and writes a and f.
+		# Once an iteration ends in the state it started in, every further
+		# one does the same until something it reads can change, so those
+		# are skipped whole.
+		bus = self.bus
+		cpu = bus.cpu
+		now = bus.cycles
+		state = (key, cpu.reg_a, cpu.reg_f)
+		until = bus.next_event
+		for reg, ofs in self.idle[key]:
+			adr = ofs + (getattr(cpu, reg) if reg else 0)
+			fn = bus.volatile.get(adr)
+			if not fn is None:
+				until = min(until, fn())
+		last = self.idle_last
+		if not last is None and last[0] == state and now < last[2]:
+			period = now - last[1]
+			# stop short of <until>, the last real iteration is the one
+			# that crosses it
+			n = (min(until, last[2]) - now - 1) // period
+			if n > 0:
+				bus.cycles += n * period
+				bus.instructions += n * len(blk)
+				now = bus.cycles
+		return (state, now, until)
 
 class Bus:
-	def __init__(self):
+	def __init__(self, bootrom='bootrom.gb'):
 		self.cpu = None
 		self.rom = None
 		self.wram = None
 		self.hram = None
 		self.vram = None
 		self.ioreg = None
+		self.ppu = None
+		self.timer = None
 
-		self.bootrom = BootROM(self)
-		self.bootrom_loaded = True
+		if bootrom is None:
+			self.bootrom = None
+			self.bootrom_loaded = False
+		else:
+			self.bootrom = BootROM(self, bootrom)
+			self.bootrom_loaded = True
 
-		self.frame_cycles = 0
+		# M-cycles since power on, everything timed is scheduled against this
+		self.cycles = 0
+		self.frame_start = 0
 		self.hit_frame = False
+		self.instructions = 0
+
+		# pending events, a heap of [cycle, seq, fn]
+		self.events = []
+		self.event_seq = 0
+		self.next_event = NO_EVENT
+		self.frame_event = self.schedule(FRAME_CYCLES, self.end_frame)
+		# called when frame timing jumps, e.g. after loading a state
+		self.timing_hooks = []
+
+		# (pc, opcode, arg) of recently executed instructions, see set_trace
+		self.trace = None
+
+		# translated code, pages flagged in code_pages hold cached blocks
+		# or can switch ROM banks, so writing there must reach the cache
+		self.blocks = BlockCache(self)
+		self.code_pages = bytearray(0x100)
+
+		# memory map: one handler per 256-byte page, plus a per-address
+		# table for the $FFxx page, which is shared between IO and HRAM
+		self.read_map = [None] * 0x100
+		self.write_map = [None] * 0x100
+		self.read_map_hi = [None] * 0x100
+		self.write_map_hi = [None] * 0x100
+		# devices holding plain memory also hand out the buffer behind an
+		# address for read_range/write_range, see span_at
+		self.read_span_map = [None] * 0x100
+		self.write_span_map = [None] * 0x100
+		self.read_span_map_hi = [None] * 0x100
+		self.write_span_map_hi = [None] * 0x100
+		# readable addresses whose value changes with time alone, address ->
+		# function giving the next cycle it may change at. Used to fast
+		# forward idle loops, anything time-based must be listed here
+		self.volatile = {}
 
 	def pass_cycle(self):
-		self.frame_cycles += 1
-		if self.frame_cycles == 17476:
-			# next frame
-			self.frame_cycles = 0
-			self.hit_frame = True
-
-		scanline = int(self.frame_cycles / 113.48052)
-		self.ioreg.write_at(0xFF44, scanline)
+		self.pass_cycles(1)
 
 	def pass_cycles(self, n):
-		for _ in range(n):
-			self.pass_cycle()
+		self.cycles += n
+		if self.cycles >= self.next_event:
+			self.run_events()
+
+	def schedule(self, cycle, fn):
+		# calls fn(cycle) once self.cycles reaches <cycle>
+		ev = [cycle, self.event_seq, fn]
+		self.event_seq += 1
+		heapq.heappush(self.events, ev)
+		if cycle < self.next_event:
+			self.next_event = cycle
+		return ev
+
+	def cancel(self, ev):
+		ev[2] = None
+
+	def compact_events(self):
+		# drops cancelled events, which otherwise only leave the heap once
+		# their cycle comes around
+		self.events = [ev for ev in self.events if not ev[2] is None]
+		heapq.heapify(self.events)
+		self.next_event = self.events[0][0] if self.events else NO_EVENT
+
+	def sync(self):
+		# forces run_events at the end of the current instruction, which
+		# also ends the running block
+		self.next_event = 0
+
+	def run_events(self):
+		events = self.events
+		while events and events[0][0] <= self.cycles:
+			cycle, _, fn = heapq.heappop(events)
+			if not fn is None:
+				fn(cycle)
+		self.next_event = events[0][0] if events else NO_EVENT
+		# anything may have changed, idle loops start counting again
+		self.blocks.idle_last = None
+		# IF, IE and IME only change in events or in instructions that
+		# sync(), so this is the one place interrupts need checking
+		self.check_interrupts()
+
+	def request_interrupt(self, bit):
+		self.ioreg.data[0x0F] |= bit
+		self.sync()
+
+	def check_interrupts(self):
+		cpu = self.cpu
+		if cpu is None or self.ioreg is None:
+			return
+		if cpu.ime_delay:
+			# ei takes effect after the instruction following it
+			cpu.ime_delay = False
+			cpu.ime = True
+			self.sync()
+			return
+		pending = self.interrupts_pending()
+		if not pending:
+			return
+		cpu.halted = False
+		if not cpu.ime:
+			return
+		bit = pending & -pending
+		self.ioreg.data[0x0F] &= ~bit
+		cpu.ime = False
+		cpu.stack_push(cpu.reg_pc)
+		cpu.reg_pc = 0x40 + 8 * (bit.bit_length() - 1)
+		self.cycles += 5
+
+	def interrupts_pending(self):
+		return self.ioreg.data[0x0F] & self.ioreg.ie & 0x1F
+
+	def halt_wait(self):
+		# nothing runs while halted, so go straight to the next event,
+		# check_interrupts wakes the CPU
+		n = max(self.next_event - self.cycles, 1)
+		self.pass_cycles(n)
+		return n
+
+	def end_frame(self, cycle):
+		# next frame
+		self.frame_start = cycle
+		self.hit_frame = True
+		self.frame_event = self.schedule(cycle + FRAME_CYCLES, self.end_frame)
+
+	@property
+	def frame_cycles(self):
+		return self.cycles - self.frame_start
+	@frame_cycles.setter
+	def frame_cycles(self, val):
+		self.frame_start = self.cycles - val
+		self.cancel(self.frame_event)
+		self.frame_event = self.schedule(self.frame_start + FRAME_CYCLES, self.end_frame)
+		for fn in self.timing_hooks:
+			fn()
+
+	def get_ly(self):
+		return int(self.frame_cycles / LINE_CYCLES)
 
 	def link_device(self, dev, obj):
 		if dev == 'CPU':
 			self.cpu = obj
 		elif dev == 'ROM':
 			self.rom = obj
+			self.map_range(obj, 0x0000, 0x7FFF)
+			self.code_pages[0x00:0x80] = b'\x01' * 0x80
+			self.map_range(obj, 0xA000, 0xBFFF)
 		elif dev == 'WRAM':
 			self.wram = obj
+			self.map_range(obj, 0xC000, 0xFDFF)
 		elif dev == 'HRAM':
 			self.hram = obj
+			self.map_range(obj, 0xFF80, 0xFFFE)
 		elif dev == 'VRAM':
 			self.vram = obj
+			self.map_range(obj, 0x8000, 0x9FFF)
 		elif dev == 'IO':
 			self.ioreg = obj
+			self.map_range(obj, 0xFF00, 0xFF7F)
+			self.map_range(obj, 0xFFFF, 0xFFFF)
+		elif dev == 'PPU':
+			self.ppu = obj
+			self.map_range(obj, 0xFE00, 0xFEFF)
+		elif dev == 'TIMER':
+			# registers live in IO, hooked in Timer.start
+			self.timer = obj
 		else:
 			raise Exception(f'Unknown device "{dev}"')
 		obj.bus = self
+		if hasattr(obj, 'start'):
+			obj.start()
+
+	def map_range(self, obj, start, end):
+		# whole pages are dispatched straight to the owner, anything
+		# smaller than a page must live in $FFxx and goes through the
+		# per-address table
+		if start & 0xFF == 0 and end & 0xFF == 0xFF:
+			for pg in range(start >> 8, (end >> 8) + 1):
+				self.read_map[pg] = obj.read_at
+				self.write_map[pg] = obj.write_at
+				self.read_span_map[pg] = getattr(obj, 'read_span', None)
+				self.write_span_map[pg] = getattr(obj, 'write_span', None)
+		elif start >> 8 == 0xFF and end >> 8 == 0xFF:
+			for i in range(start & 0xFF, (end & 0xFF) + 1):
+				self.read_map_hi[i] = obj.read_at
+				self.write_map_hi[i] = obj.write_at
+				self.read_span_map_hi[i] = getattr(obj, 'read_span', None)
+				self.write_span_map_hi[i] = getattr(obj, 'write_span', None)
+			self.read_map[0xFF] = self.read_hi
+			self.write_map[0xFF] = self.write_hi
+		else:
+			raise Exception(f'Cannot map ${start:0>4X}-${end:0>4X}')
+
+	def read_hi(self, adr):
+		fn = self.read_map_hi[adr & 0xFF]
+		if fn is None: return None
+		return fn(adr)
 
-	def get_devices(self):
-		dev = []
-		if not self.cpu   is None: dev.append(self.cpu)
-		if not self.rom   is None: dev.append(self.rom)
-		if not self.wram  is None: dev.append(self.wram)
-		if not self.hram  is None: dev.append(self.hram)
-		if not self.vram  is None: dev.append(self.vram)
-		if not self.ioreg is None: dev.append(self.ioreg)
-		return dev
+	def write_hi(self, adr, val):
+		fn = self.write_map_hi[adr & 0xFF]
+		if not fn is None:
+			fn(adr, val)
 
 	def write_at(self, adr, val):
 		# BOOTROM DISABLE ADDR
 		if adr == 0xFF50 and val != 1:
 			self.bootrom = None
 			self.bootrom_loaded = False
-		for dev in self.get_devices():
-			dev.write_at(adr, val)
+		fn = self.write_map[adr >> 8]
+		if not fn is None:
+			fn(adr, val)
+		if 0xE000 <= adr < 0xFE00:
+			# echo RAM, blocks are cached under the WRAM address
+			adr -= 0x2000
+		if self.code_pages[adr >> 8]:
+			self.blocks.invalidate(adr)
 
 	def read_at(self, adr):
 		if self.bootrom_loaded and adr < 0x100:
 			return self.bootrom.data[adr]
-		b = None
-		for dev in self.get_devices():
-			new_b = dev.read_at(adr)
-			if new_b is None: continue
+		fn = self.read_map[adr >> 8]
+		if not fn is None:
+			b = fn(adr)
 			if not b is None:
-				# bus contention
-				b = random.randint(0, 255)
+				return b
+		# open bus
+		if adr >= 0x8000 or not self.rom is None:
+			print(f'open bus @ ${adr:0>4X}')
+		return 0xFF
+
+	def span_at(self, adr, n=None):
+		# (buffer, index, count): the run of plain memory starting at <adr>,
+		# for writing <n> bytes if given. None where the address has to go
+		# through read_at/write_at
+		if adr >> 8 == 0xFF:
+			maps = self.read_span_map_hi if n is None else self.write_span_map_hi
+			fn = maps[adr & 0xFF]
+		else:
+			maps = self.read_span_map if n is None else self.write_span_map
+			fn = maps[adr >> 8]
+		if fn is None:
+			return None
+		if n is None:
+			if self.bootrom_loaded and adr < 0x100:
+				return None
+			return fn(adr)
+		return fn(adr, n)
+
+	def read_range(self, adr, n):
+		if adr + n > 0x10000:
+			raise Exception(f'Range ${adr:0>4X}+{n} is past the end of memory')
+		out = bytearray()
+		end = adr + n
+		while adr < end:
+			span = self.span_at(adr)
+			if span is None:
+				out.append(self.read_at(adr))
+				adr += 1
 			else:
-				b = new_b
-		if b is None:
-			# open bus
-			if adr >= 0x8000 or not self.rom is None:
-				print(f'open bus @ ${adr:0>4X}')
-			b = 0xFF
-		return b
+				buf, i, cnt = span
+				cnt = min(cnt, end - adr)
+				out += buf[i:i + cnt]
+				adr += cnt
+		return bytes(out)
+
+	def write_range(self, adr, data):
+		n = len(data)
+		if adr + n > 0x10000:
+			raise Exception(f'Range ${adr:0>4X}+{n} is past the end of memory')
+		end = adr + n
+		pos = 0
+		while adr < end:
+			span = self.span_at(adr, end - adr)
+			if span is None:
+				self.write_at(adr, data[pos])
+				adr += 1
+				pos += 1
+				continue
+			buf, i, cnt = span
+			cnt = min(cnt, end - adr)
+			buf[i:i + cnt] = data[pos:pos + cnt]
+			for pg in range(adr >> 8, (adr + cnt - 1 >> 8) + 1):
+				if 0xE0 <= pg < 0xFE:
+					pg -= 0x20
+				if not self.code_pages[pg]:
+					continue
+				if pg == 0xFF:
+					# HRAM code is tracked per address
+					for a in range(max(adr, 0xFF00), adr + cnt):
+						self.blocks.invalidate(a)
+				else:
+					self.blocks.invalidate(pg << 8)
+			adr += cnt
+			pos += cnt
 
 	def read_at_pc(self):
 		b = self.read_at(self.cpu.reg_pc)
 		self.cpu.reg_pc += 1
 		return b
 
-	def do_instruction(self):
-		if self.cpu is None: return
-		raw = f'${self.cpu.reg_pc:0>4X}  '
+	def fetch(self):
+		# reads the instruction at pc, returns (pc, opcode, arg)
+		pc = self.cpu.reg_pc
 		opcode = self.read_at_pc()
-		raw += f'{opcode:0>2X}'
-		if not opcode in OPCODES.keys():
-			print(f'Unknown opcode ${opcode:0>2X} at ${self.cpu.reg_pc-1:0>4X}')
-			return 'INVALID OPCODE'
-
-		narg, cycles, disasm = OPCODES[opcode]
+		narg = OP_NARGS[opcode]
 		if narg == 0:
 			arg = None
-			raw += f'      '
 		elif narg == 1:
 			arg = self.read_at_pc()
-			raw += f' {arg:0>2X}   '
 		elif narg == 2:
 			arg = self.read_at_pc()
-			raw += f' {arg:0>2X} '
-			arg2 = self.read_at_pc()
-			raw += f'{arg2:0>2X}'
-			arg |= arg2 << 8
+			arg |= self.read_at_pc() << 8
+		else:
+			print(f'Unknown opcode ${opcode:0>2X} at ${pc:0>4X}')
+			return None
+		return pc, opcode, arg
+
+	def execute(self, opcode, arg):
 		if opcode == 0xCB:
 			# special
-			dis_str = self.cpu.run_opcode_cb(arg)
+			self.cpu.run_opcode_cb(arg)
+			cycles = OP_CYCLES[0xCB]
 			if arg & 0b111 == 0b110:
 				cycles += 1
 		else:
-			dis_dict = {
-				'val': arg,
-				'rel': self.cpu.reg_pc + signb(arg),
-			}
-			# ~ print(disasm)
-			# ~ print(dis_dict)
-			dis_str = disasm.format(**dis_dict)
-			ext_cycles = self.cpu.run_opcode(opcode, arg)
-			cycles += ext_cycles
-
+			cycles = OP_CYCLES[opcode] + self.cpu.run_opcode(opcode, arg)
+		self.instructions += 1
 		self.pass_cycles(cycles)
+		return cycles
+
+	def step(self):
+		# runs one instruction without building any strings, returns the
+		# cycles taken or None on an invalid opcode
+		self.blocks.idle_last = None
+		if self.cpu.halted:
+			return self.halt_wait()
+		ins = self.fetch()
+		if ins is None: return None
+		if not self.trace is None:
+			self.trace.append(ins)
+		return self.execute(ins[1], ins[2])
+
+	def run(self, n):
+		for _ in range(n):
+			if self.step() is None:
+				return False
+		return True
+
+	def run_until_frame(self, breakpoint=-1):
+		# returns True once a frame completes, False when stopped early
+		cpu = self.cpu
+		blocks = self.blocks
+		# blocks only stop at their ends, so tracing and breakpoints need
+		# the one-instruction path
+		fast = self.trace is None and breakpoint < 0
+		while True:
+			if cpu.halted:
+				self.halt_wait()
+			elif fast and blocks.run():
+				pass
+			elif self.step() is None:
+				return False
+			if cpu.reg_pc == breakpoint:
+				return False
+			if self.hit_frame:
+				self.hit_frame = False
+				return True
+
+	def run_cycles(self, n):
+		# runs for at least <n> M-cycles, False if stopped early
+		stop = self.schedule(self.cycles + n, lambda cycle: None)
+		target = stop[0]
+		blocks = self.blocks
+		cpu = self.cpu
+		fast = self.trace is None
+		while self.cycles < target:
+			if cpu.halted:
+				self.halt_wait()
+			elif fast and blocks.run():
+				pass
+			elif self.step() is None:
+				self.cancel(stop)
+				return False
+		return True
 
-		return raw + '   |   ' + dis_str
+	def set_trace(self, n):
+		# keep the last <n> executed instructions, 0 turns tracing off
+		self.trace = collections.deque(maxlen=n) if n else None
+
+	def do_instruction(self):
+		if self.cpu is None: return
+		self.blocks.idle_last = None
+		if self.cpu.halted:
+			n = self.halt_wait()
+			return f'${self.cpu.reg_pc:0>4X}             |   halted for {n} cycles'
+		ins = self.fetch()
+		if ins is None:
+			return 'INVALID OPCODE'
+		if not self.trace is None:
+			self.trace.append(ins)
+		self.execute(ins[1], ins[2])
+		return disassemble(*ins)
+
+def disassemble(pc, opcode, arg):
+	narg, cycles, disasm = OPCODES[opcode]
+	raw = f'${pc:0>4X}  {opcode:0>2X}'
+	if narg == 0:
+		raw += f'      '
+	elif narg == 1:
+		raw += f' {arg:0>2X}   '
+	elif narg == 2:
+		raw += f' {arg & 0xFF:0>2X} {arg >> 8:0>2X}'
+	if opcode == 0xCB:
+		dis_str = CB_OPCODES[arg]
+	else:
+		dis_str = disasm.format(val=arg, rel=pc + 1 + narg + signb(arg))
+	return raw + '   |   ' + dis_str
 
 def signb(i):
 	if i is None: return 0
@@ -1098,8 +2934,8 @@ def signb(i):
 	return i - 0x100
 
 class Emu:
-	def __init__(self):
-		self.bus = Bus()
+	def __init__(self, bootrom='bootrom.gb'):
+		self.bus = Bus(bootrom)
 
 		self.cpu = CPU()
 		self.bus.link_device('CPU', self.cpu)
@@ -1111,10 +2947,291 @@ class Emu:
 		self.bus.link_device('VRAM', self.vram)
 		self.ioreg = IOReg()
 		self.bus.link_device('IO', self.ioreg)
+		self.ppu = PPU()
+		self.bus.link_device('PPU', self.ppu)
+		self.timer = Timer()
+		self.bus.link_device('TIMER', self.timer)
+		self.rom = None
+
+		if bootrom is None:
+			# start where the boot ROM would have handed over
+			self.cpu.reg_pc = 0x0100
 
 	def load_rom(self, rom):
 		self.rom = rom
 		self.bus.link_device('ROM', rom)
 
+	def set_buttons(self, buttons):
+		self.ioreg.set_buttons(buttons)
+
+	def close(self):
+		# writes back the battery save
+		if not self.rom is None:
+			self.rom.close()
+
+	def state_memories(self):
+		# every RAM block in save state order
+		mems = (
+			self.wram.data, self.hram.hram, self.vram.data,
+			self.ioreg.data, self.ppu.oam,
+			# the finished frame and the one being drawn
+			self.ppu.front, self.ppu.back,
+		)
+		if not self.rom is None:
+			mems += (self.rom.ram,)
+		return mems
+
+	def save_state(self):
+		cpu = self.cpu
+		bus = self.bus
+		mbc = MBC(None) if self.rom is None else self.rom.mbc
+		head = STATE_HEAD.pack(
+			STATE_MAGIC, STATE_VERSION,
+			cpu.reg_a, cpu.reg_f, cpu.reg_b, cpu.reg_c,
+			cpu.reg_d, cpu.reg_e, cpu.reg_h, cpu.reg_l,
+			cpu.reg_sp, cpu.reg_pc,
+			bus.cycles, bus.frame_cycles, bus.instructions,
+			bus.bootrom_loaded, bus.hit_frame,
+			mbc.rom_bank, mbc.ram_bank, mbc.ram_loaded, mbc.mode,
+			self.ppu.window_line,
+			cpu.halted, self.ioreg.ie, cpu.ime, cpu.ime_delay,
+			(bus.cycles - self.timer.div_base) & 0xFFFF, self.timer.read_tima(),
+			not self.ppu.hblank_event is None, self.ioreg.serial_left(),
+			self.ppu.frame_count,
+		)
+		return head + b''.join(self.state_memories())
+
+	def load_state(self, blob):
+		cpu = self.cpu
+		bus = self.bus
+		# everything is checked before any of it is applied, a rejected
+		# state leaves the machine as it was
+		if len(blob) < STATE_HEAD.size:
+			raise Exception(f'Save state is truncated ({len(blob)} bytes)')
+		(magic, version,
+		a, f, b, c, d, e, h, l, sp, pc,
+		cycles, frame_cycles, instructions,
+		bootrom_loaded, hit_frame,
+		rom_bank, ram_bank, ram_loaded, mode,
+		window_line,
+		halted, ie, ime, ime_delay,
+		div_counter, tima,
+		hblank, serial_left, frame_count) = STATE_HEAD.unpack_from(blob)
+		if magic != STATE_MAGIC or version != STATE_VERSION:
+			raise Exception(f'Unsupported save state (version {version})')
+		if bootrom_loaded and bus.bootrom is None:
+			raise Exception('Save state needs the boot ROM, which is no longer loaded')
+		size = STATE_HEAD.size + sum(map(len, self.state_memories()))
+		if len(blob) != size:
+			raise Exception(f'Save state is {len(blob)} bytes, expected {size}')
+		(cpu.reg_a, cpu.reg_f, cpu.reg_b, cpu.reg_c,
+		cpu.reg_d, cpu.reg_e, cpu.reg_h, cpu.reg_l) = a, f, b, c, d, e, h, l
+		cpu.reg_sp = sp
+		cpu.reg_pc = pc
+		bus.instructions = instructions
+		cpu.halted = halted
+		self.ioreg.ie = ie
+		cpu.ime = ime
+		cpu.ime_delay = ime_delay
+		bus.bootrom_loaded = bool(bootrom_loaded)
+		bus.hit_frame = bool(hit_frame)
+		bus.cycles = cycles
+		bus.frame_cycles = frame_cycles
+		self.ppu.restore(window_line, hblank)
+		self.ppu.frame_count = frame_count
+		self.ioreg.restore_serial(serial_left)
+		if not self.rom is None:
+			mbc = self.rom.mbc
+			mbc.rom_bank = rom_bank
+			mbc.ram_bank = ram_bank
+			mbc.ram_loaded = bool(ram_loaded)
+			mbc.mode = mode
+			mbc.update()
+		ofs = STATE_HEAD.size
+		for m in self.state_memories():
+			m[:] = blob[ofs:ofs + len(m)]
+			ofs += len(m)
+		self.timer.restore(div_counter, tima)
+		self.vram.touch_all()
+		if not self.rom is None:
+			self.rom.touch_ram()
+		# every event was cancelled and re-created against the new cycles
+		bus.compact_events()
+		bus.blocks.clear()
+
+FRAME_RATE = 4194304 / 4 / FRAME_CYCLES
+
+def xor_bytes(a, b):
+	return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+class Rewind:
+	def __init__(self, emu, seconds=10, keyframe_every=30):
+		self.emu = emu
+		self.keyframe_every = keyframe_every
+		# (compressed keyframe, compressed xor delta or None) per frame,
+		# deltas hold on to their keyframe so old ones drop out together
+		self.frames = collections.deque(maxlen=max(1, int(seconds * FRAME_RATE)))
+		self.key = None
+		self.key_raw = None
+		self.since_key = 0
+
+	def push(self):
+		# call once per completed frame
+		state = self.emu.save_state()
+		if self.key is None or self.since_key >= self.keyframe_every or len(state) != len(self.key_raw):
+			self.key_raw = state
+			self.key = zlib.compress(state, 1)
+			self.since_key = 0
+			self.frames.append((self.key, None))
+		else:
+			self.frames.append((self.key, zlib.compress(xor_bytes(state, self.key_raw), 1)))
+		self.since_key += 1
+
+	def rewind(self, n=1):
+		# goes back <n> stored frames, False if there is nothing to go to
+		if len(self.frames) < 2:
+			return False
+		for _ in range(min(n, len(self.frames) - 1)):
+			self.frames.pop()
+		key, delta = self.frames[-1]
+		state = zlib.decompress(key)
+		if not delta is None:
+			state = xor_bytes(state, zlib.decompress(delta))
+		self.emu.load_state(state)
+		# later frames are keyed off a fresh keyframe
+		self.key = None
+		return True
+
+	def clear(self):
+		self.frames.clear()
+		self.key = None
+		self.key_raw = None
+
+# save state header: magic, version, a f b c d e h l, sp, pc, cycles,
+# frame_cycles, instructions, bootrom_loaded, hit_frame, rom_bank,
+# ram_bank, ram_loaded, mode, window_line, halted, ie, ime, ime_delay, the
+# timer's internal counter, TIMA, whether the line's hblank STAT interrupt
+# is still due, the cycles left of a serial transfer and the PPU's
+# frame_count; followed by the memories in Emu.state_memories, the last
+# one being the cart RAM
+STATE_MAGIC = b'GBst'
+STATE_VERSION = 9
+STATE_HEAD = struct.Struct('<4sB8BHHQIQ??HB?BB?B??HB?II')
+
+def disassemble_rom(rom, start, count):
+	pc = start
+	for _ in range(count):
+		opcode = rom.read_at(pc)
+		narg = OP_NARGS[opcode]
+		if narg < 0:
+			print(f'${pc:0>4X}  {opcode:0>2X}         |   db ${opcode:0>2X}')
+			pc += 1
+			continue
+		arg = None
+		if narg == 1:
+			arg = rom.read_at(pc + 1)
+		elif narg == 2:
+			arg = rom.read_at(pc + 1) | (rom.read_at(pc + 2) << 8)
+		print(disassemble(pc, opcode, arg))
+		pc += 1 + narg
+
+def verify_paths(f_rom, frames, bootrom=None):
+	# runs <f_rom> on the block path and on the one-instruction path side
+	# by side, returns the first frame their save states differ after or
+	# None. VRAM starts out random, so both get the same seed
+	emus = []
+	for trace in (0, 1):
+		random.seed(0)
+		e = Emu(bootrom)
+		e.load_rom(ROM(f_rom))
+		e.bus.set_trace(trace)
+		emus.append(e)
+	for i in range(frames):
+		for e in emus:
+			e.bus.run_until_frame()
+		if emus[0].save_state() != emus[1].save_state():
+			return i
+	return None
+
+def main(argv=None):
+	import argparse, time
+	parser = argparse.ArgumentParser(description='Headless Game Boy emulator')
+	sub = parser.add_subparsers(dest='cmd', required=True)
+	p_run = sub.add_parser('run', help='run a ROM with no display')
+	p_bench = sub.add_parser('bench', help='report emulation speed')
+	p_dis = sub.add_parser('disasm', help='disassemble ROM contents')
+	p_trace = sub.add_parser('trace', help='print each executed instruction')
+	p_verify = sub.add_parser('verify', help='check the block path against stepping')
+	for p in (p_run, p_bench, p_dis, p_trace, p_verify):
+		p.add_argument('rom')
+	for p in (p_run, p_bench, p_trace, p_verify):
+		p.add_argument('--bootrom', default=None, help='boot ROM image, skipped if not given')
+	for p in (p_run, p_bench, p_verify):
+		p.add_argument('--frames', type=int, default=600)
+	for p in (p_run, p_bench):
+		p.add_argument('--cycles', type=int, default=None, help='run M-cycles instead of frames')
+	p_run.add_argument('--sav', default=None, help='battery save, created if missing')
+	p_dis.add_argument('--start', type=lambda x: int(x, 16), default=0x100, help='hex address')
+	p_dis.add_argument('--bank', type=int, default=1)
+	p_dis.add_argument('--count', type=int, default=32)
+	p_trace.add_argument('--count', type=int, default=1000)
+	p_trace.add_argument('--last', action='store_true', help='only print the final --count instructions')
+	p_trace.add_argument('--frames', type=int, default=1, help='frames to run with --last')
+	args = parser.parse_args(argv)
+
+	if args.cmd == 'verify':
+		frame = verify_paths(args.rom, args.frames, args.bootrom)
+		if frame is None:
+			print(f'{args.frames} frames, block and step paths match')
+			return 0
+		print(f'block and step paths differ after frame {frame}')
+		return 1
+
+	rom = ROM(args.rom, getattr(args, 'sav', None))
+	if args.cmd == 'disasm':
+		rom.set_rom_bank(args.bank)
+		disassemble_rom(rom, args.start, args.count)
+		return 0
+
+	emu = Emu(args.bootrom)
+	emu.load_rom(rom)
+	bus = emu.bus
+
+	if args.cmd == 'trace':
+		if args.last:
+			bus.set_trace(args.count)
+			for _ in range(args.frames):
+				if not bus.run_until_frame():
+					break
+			for ins in bus.trace:
+				print(disassemble(*ins))
+		else:
+			for _ in range(args.count):
+				s = bus.do_instruction()
+				print(s)
+				if s == 'INVALID OPCODE':
+					break
+		return 0
+
+	t = time.perf_counter()
+	if args.cycles is None:
+		frames = 0
+		while frames < args.frames and bus.run_until_frame():
+			frames += 1
+	else:
+		bus.run_cycles(args.cycles)
+	dt = time.perf_counter() - t
+	frames = bus.cycles / FRAME_CYCLES
+	print(f'{frames:.1f} frames, {bus.cycles} cycles, {bus.instructions} instructions in {dt:.3f} s')
+	if args.cmd == 'bench':
+		print(f'{frames / dt:.1f} frames/s ({frames / dt / FRAME_RATE:.2f}x real time)')
+		print(f'{bus.instructions / dt:.0f} instructions/s')
+	else:
+		c = emu.cpu
+		print(f'af={c.reg_af:0>4X} bc={c.reg_bc:0>4X} de={c.reg_de:0>4X} hl={c.reg_hl:0>4X} sp={c.reg_sp:0>4X} pc={c.reg_pc:0>4X}')
+	emu.close()
+	return 0
+
 if __name__ == '__main__':
-	pass
+	import sys
+	sys.exit(main())
@@ -1,21 +1,41 @@
+import collections, os, queue, threading, time, traceback
 import pygame
+import numpy as np
 import emu
 
 BREAKPOINT = -1
+# how often the core hands the UI a snapshot in turbo mode
+DISPLAY_RATE = 60
+MAX_SKIP = 64
 
 class Font:
+	# rendered strings kept around, most of the debugger text is unchanged
+	# from one frame to the next
+	CACHE_SIZE = 256
+
 	def __init__(self):
 		self.surf = pygame.image.load('ascii_font.png')
 		self.surf.set_colorkey(pygame.Color(255, 255, 255))
+		self.glyphs = [self.surf.subsurface(self.getc(i)) for i in range(0x80)]
+		self.cache = collections.OrderedDict()
 
 	def render(self, txt):
+		s_out = self.cache.get(txt)
+		if not s_out is None:
+			self.cache.move_to_end(txt)
+			return s_out
 		lins = txt.split('\n')
 		w = max([len(x) for x in lins])
 		h = len(lins)
 		s_out = pygame.Surface((w * 8, h * 8), pygame.SRCALPHA)
-		for y,l in enumerate(lins):
-			for x,c in enumerate(l):
-				s_out.blit(self.surf, (x*8, y*8), self.getc(ord(c)))
+		glyphs = self.glyphs
+		s_out.blits([
+			(glyphs[min(ord(c), 0x7F)], (x*8, y*8))
+			for y,l in enumerate(lins) for x,c in enumerate(l)
+		], False)
+		self.cache[txt] = s_out
+		if len(self.cache) > self.CACHE_SIZE:
+			self.cache.popitem(last=False)
 		return s_out
 
 	def getc(self, i):
@@ -39,6 +59,204 @@ BASE_PAL = (
 	pygame.Color( 52, 104,  86),
 	pygame.Color(  8,  24,  32),
 )
+PAL_RGB = np.array([(c.r, c.g, c.b) for c in BASE_PAL], dtype=np.uint8)
+
+def decode_tiles(buf):
+	# 2bpp tile data -> array of colour indices shaped (tile, y, x)
+	data = np.frombuffer(bytes(buf), dtype=np.uint8).reshape(-1, 8, 2)
+	lo = np.unpackbits(data[:, :, 0, None], axis=2)
+	hi = np.unpackbits(data[:, :, 1, None], axis=2)
+	return (hi << 1) | lo
+
+def tile_sheet(tiles, cols):
+	# (tile, y, x) -> (x, y) pixel array, <cols> tiles per row
+	rows = tiles.shape[0] // cols
+	img = tiles.reshape(rows, cols, 8, 8).transpose(0, 2, 1, 3).reshape(rows * 8, cols * 8)
+	return img.T
+
+class Snapshot:
+	# what the UI draws, copied out of the emulator by the core thread
+	def __init__(self):
+		self.frame = bytearray(160 * 144)
+		self.frame_count = -1
+		self.regs = (0, 0, 0, 0, 0, 0)
+		self.lcdc = 0
+		self.stat = 0
+		self.ly = 0
+		self.frame_cycles = 0
+		self.trace = []
+		self.ram = bytes(0x80)
+		self.tiles = bytearray(0x1800)
+		self.bgmap0 = bytes(0x400)
+		self.vram_serial = -1
+		self.tile_serial = [0] * 384
+		self.map_serial = [0] * 0x800
+		self.running = False
+		self.turbo = False
+		self.skip = 1
+
+class Core(threading.Thread):
+	# runs the emulator on its own thread, paced to real time. The UI sends
+	# commands through <commands> and picks up the newest Snapshot with
+	# snapshot(), the core fills <back> and swaps it with <ready>.
+	# In turbo mode frames run unpaced and only every <skip>th one is
+	# published, <skip> follows the frame rate to publish at DISPLAY_RATE.
+	def __init__(self, e):
+		super().__init__(daemon=True)
+		self.emu = e
+		self.rewind = emu.Rewind(e)
+		self.running = False
+		self.turbo = False
+		self.trace_len = 0 if e.bus.trace is None else e.bus.trace.maxlen
+		self.skip = 1
+		self.skipped = 0
+		self.published = time.perf_counter()
+		self.alive = True
+		self.commands = queue.Queue()
+		self.lock = threading.Lock()
+		self.back = Snapshot()
+		self.ready = Snapshot()
+		self.shown = Snapshot()
+		self.fresh = False
+		self.publish()
+
+	def send(self, *cmd):
+		self.commands.put(cmd)
+
+	def stop(self):
+		# waits for the core to write back the battery save
+		self.send('quit')
+		self.join()
+
+	def snapshot(self):
+		with self.lock:
+			if self.fresh:
+				self.ready, self.shown = self.shown, self.ready
+				self.fresh = False
+		return self.shown
+
+	def publish(self):
+		e = self.emu
+		bus = e.bus
+		cpu = e.cpu
+		vram = e.vram
+		s = self.back
+		s.frame[:] = e.ppu.frame
+		s.frame_count = e.ppu.frame_count
+		s.regs = (cpu.reg_af, cpu.reg_bc, cpu.reg_de, cpu.reg_hl, cpu.reg_sp, cpu.reg_pc)
+		s.lcdc = e.ioreg.data[0x40]
+		s.stat = e.ioreg.data[0x41]
+		s.ly = bus.get_ly()
+		s.frame_cycles = bus.frame_cycles
+		s.trace = [] if bus.trace is None else list(bus.trace)
+		s.ram = bus.read_range(0x8000, 0x80)
+		s.tiles[:] = vram.view[:0x1800]
+		s.bgmap0 = bytes(vram.bgmap0)
+		s.vram_serial = vram.checkpoint()
+		s.tile_serial = vram.tile_serial[:]
+		s.map_serial = vram.map_serial[:]
+		s.running = self.running
+		s.turbo = self.turbo
+		s.skip = self.skip
+		with self.lock:
+			self.back, self.ready = self.ready, self.back
+			self.fresh = True
+
+		now = time.perf_counter()
+		if self.turbo and self.skipped:
+			rate = self.skipped / max(now - self.published, 1e-6)
+			self.skip = max(1, min(MAX_SKIP, round(rate / DISPLAY_RATE)))
+		self.skipped = 0
+		self.published = now
+
+	def set_turbo(self, on):
+		# the trace keeps run_until_frame off the block engine
+		self.turbo = on
+		self.skip = 1
+		self.emu.bus.set_trace(0 if on else self.trace_len)
+
+	def command(self, cmd, *args):
+		bus = self.emu.bus
+		if cmd == 'run':
+			self.running = not self.running
+		elif cmd == 'turbo':
+			self.set_turbo(not self.turbo)
+		elif cmd == 'step':
+			self.running = False
+			if bus.step() is None:
+				print('unknown opcode')
+		elif cmd == 'frame':
+			self.running = False
+			self.run_frame()
+		elif cmd == 'rewind':
+			self.running = False
+			self.rewind.rewind()
+		elif cmd == 'buttons':
+			self.emu.set_buttons(args[0])
+		elif cmd == 'write':
+			adr, data = args
+			for i, val in enumerate(data):
+				bus.write_at(adr + i, val)
+		elif cmd == 'quit':
+			self.running = False
+			self.alive = False
+		else:
+			raise Exception(f'Unknown command "{cmd}"')
+
+	def run_frame(self):
+		if self.emu.bus.run_until_frame(BREAKPOINT):
+			self.rewind.push()
+		else:
+			self.running = False
+
+	def run(self):
+		period = 1 / emu.FRAME_RATE
+		deadline = time.perf_counter()
+		while self.alive:
+			try:
+				# block while paused, there is nothing to do until told
+				cmd = self.commands.get(not self.running)
+				while True:
+					self.command(*cmd)
+					cmd = self.commands.get_nowait()
+			except queue.Empty:
+				pass
+			except Exception:
+				self.running = False
+				traceback.print_exc()
+			if self.running:
+				try:
+					self.run_frame()
+				except Exception:
+					self.running = False
+					traceback.print_exc()
+				self.skipped += 1
+				now = time.perf_counter()
+				deadline += period
+				if self.turbo:
+					deadline = now
+					if self.running and self.skipped < self.skip:
+						continue
+				elif deadline > now:
+					time.sleep(deadline - now)
+				elif now - deadline > period * 4:
+					# too far behind to catch up, start over from here
+					deadline = now
+			else:
+				deadline = time.perf_counter()
+			self.publish()
+		self.emu.close()
+
+KEY_BUTTONS = (
+	(pygame.K_RIGHT, emu.BTN_RIGHT),
+	(pygame.K_LEFT, emu.BTN_LEFT),
+	(pygame.K_UP, emu.BTN_UP),
+	(pygame.K_DOWN, emu.BTN_DOWN),
+	(pygame.K_x, emu.BTN_A),
+	(pygame.K_c, emu.BTN_B),
+	(pygame.K_RSHIFT, emu.BTN_SELECT),
+	(pygame.K_RETURN, emu.BTN_START),
+)
 
 class Game:
 	def __init__(self):
@@ -47,146 +265,112 @@ class Game:
 		self.vram_surf = None
 
 		self.win = pygame.display.set_mode((800, 600))
+		self.clock = pygame.time.Clock()
 
-	def do_one_instruction(self):
-		try:
-			dis_str = self.emu.bus.do_instruction()
-		except Exception as e:
-			self.running = False
-			dis_str = 'UNKNOWN OPCODE'
-			raise
-		if len(self.last_dis) >= 30:
-			self.last_dis.pop(0)
-		self.last_dis.append(dis_str)
-
-	def do_n_instructions(self, n):
-		for _ in range(n):
-			self.do_one_instruction()
-			if self.emu.cpu.reg_pc == BREAKPOINT:
-				self.running = False
-				return
-
-	def do_instructions_until_frame(self):
-		while True:
-			self.do_one_instruction()
-			if self.emu.cpu.reg_pc == BREAKPOINT:
-				self.running = False
-				return
-			if self.emu.bus.hit_frame:
-				self.emu.bus.hit_frame = False
-				return
-
-	def do_instructions_until_frame_then_stop(self):
-		while True:
-			self.do_one_instruction()
-			if self.emu.cpu.reg_pc == BREAKPOINT:
-				self.running = False
-				return
-			if self.emu.bus.hit_frame:
-				self.emu.bus.hit_frame = False
-				self.running = False
-				return
-
-	def get_tiles_surf(self, which):
-		if which == 0:
-			lst = self.emu.vram.tile0
-		elif which == 1:
-			lst = self.emu.vram.tile1
-		elif which == 2:
-			lst = self.emu.vram.tile2
+	def get_tiles_surf(self, snap, which):
 		s = pygame.Surface((16 * 8, 8 * 8))
-		px = pygame.PixelArray(s)
-		for til_y in range(8):
-			for til_x in range(16):
-				til_i = til_y * 16 + til_x
-				for px_y in range(8):
-					byt0_i = til_i * 16 + px_y * 2
-					byt1_i = til_i * 16 + px_y * 2 + 1
-					b0 = lst[byt0_i]
-					b1 = lst[byt1_i]
-					for px_x in range(8):
-						c_i = (((b1 >> (7 - px_x)) & 1) << 1) | ((b0 >> (7 - px_x)) & 1)
-						px[til_x * 8 + px_x, til_y * 8 + px_y] = BASE_PAL[c_i]
+		data = snap.tiles[which * 0x800:(which + 1) * 0x800]
+		pygame.surfarray.blit_array(s, PAL_RGB[tile_sheet(decode_tiles(data), 16)])
 		return s
 
-	def get_bgmap_surf(self, which, tiles):
-		def get_tile(i):
-			# work on this
-			if i < 0x80:
-				s = tiles[0]
-			else:
-				s = tiles[1]
-				i -= 0x80
-			x = (i % 16) * 8
-			y = (i // 16) * 8
-			return s.subsurface(pygame.Rect(x, y, 8, 8))
-		sout = pygame.Surface((256, 256))
-		if which == 0:
-			lst = self.emu.vram.bgmap0
-		elif which == 1:
-			lst = self.emu.vram.bgmap1
-		for y in range(32):
-			for x in range(32):
-				i = y * 32 + x
-				t = lst[i]
-				sout.blit(get_tile(t), (x * 8, y * 8))
-		return sout
-
-	def get_vram(self):
-		t0 = self.get_tiles_surf(0)
-		t1 = self.get_tiles_surf(1)
-		t2 = self.get_tiles_surf(2)
-		mp = self.get_bgmap_surf(0, (t0, t1, t2))
+	def update_tiles(self, snap, tiles):
+		if len(tiles) > 96:
+			self.tile_surfs = [self.get_tiles_surf(snap, i) for i in range(3)]
+			return
+		data = np.frombuffer(snap.tiles, dtype=np.uint8)
+		decoded = decode_tiles(data.reshape(384, 16)[tiles])
+		for t, px in zip(tiles, decoded):
+			i = t & 0x7F
+			sub = self.tile_surfs[t >> 7].subsurface(pygame.Rect((i % 16) * 8, (i // 16) * 8, 8, 8))
+			pygame.surfarray.blit_array(sub, PAL_RGB[px.T])
+
+	def update_bgmap(self, snap, cells):
+		# work on this
+		lst = snap.bgmap0
+		for i in cells:
+			t = lst[i]
+			src = pygame.Rect(((t & 0x7F) % 16) * 8, ((t & 0x7F) // 16) * 8, 8, 8)
+			self.bgmap_surf.blit(self.tile_surfs[t >> 7], ((i % 32) * 8, (i // 32) * 8), src)
+
+	def get_vram(self, snap):
+		# only redraws what VRAM reports as changed since the last call
+		since = self.vram_serial
+		self.vram_serial = snap.vram_serial
+		tiles = [i for i, s in enumerate(snap.tile_serial) if s > since]
+		cells = set(i for i, s in enumerate(snap.map_serial[:0x400]) if s > since)
+		if not tiles and not cells and not self.vram_surf is None:
+			return
+
+		if self.vram_surf is None:
+			self.tile_surfs = [pygame.Surface((16 * 8, 8 * 8)) for _ in range(3)]
+			self.bgmap_surf = pygame.Surface((256, 256))
+		if tiles:
+			self.update_tiles(snap, tiles)
+			# map cells showing a changed tile
+			shown = set(t for t in tiles if t < 0x100)
+			lst = snap.bgmap0
+			cells.update(i for i in range(0x400) if lst[i] in shown)
+		self.update_bgmap(snap, cells)
 
 		s = pygame.Surface((392, 256))
 		s.fill(pygame.Color(248,248,248))
-		s.blit(t0, (0, 0))
-		s.blit(t1, (0, 64))
-		s.blit(t2, (0, 128))
-		s.blit(mp, (136, 0))
+		s.blit(self.tile_surfs[0], (0, 0))
+		s.blit(self.tile_surfs[1], (0, 64))
+		s.blit(self.tile_surfs[2], (0, 128))
+		s.blit(self.bgmap_surf, (136, 0))
 		self.vram_surf = s
 
-	def get_ram_row(self, row):
-		s = ''
-		for i in range(0x10):
-			b = self.emu.bus.read_at(row * 0x10 + i)
-			if i: s += ' '
-			s += f'{b:0>2X}'
-		return s
+	def get_screen(self, snap):
+		if snap.frame_count == self.screen_count and not self.screen_surf is None:
+			return
+		self.screen_count = snap.frame_count
+		px = np.frombuffer(snap.frame, dtype=np.uint8).reshape(144, 160)
+		s = pygame.surfarray.make_surface(PAL_RGB[px.T])
+		self.screen_surf = pygame.transform.scale(s, (320, 288))
+
+	def get_ram_row(self, snap, row):
+		return ' '.join(f'{b:0>2X}' for b in snap.ram[row * 0x10:(row + 1) * 0x10])
 
 	def run(self):
 		fn = 'tetris.gb'
 
-		self.emu = emu.Emu()
-		self.emu.load_rom(emu.ROM(fn))
+		e = emu.Emu()
+		e.load_rom(emu.ROM(fn, os.path.splitext(fn)[0] + '.sav'))
+		e.bus.set_trace(30)
 
-		self.last_dis = []
-		self.running = False
+		self.vram_surf = None
+		self.vram_serial = -1
+		self.screen_surf = None
+		self.screen_count = -1
+		self.buttons = 0
+		self.core = Core(e)
+		self.core.start()
 
 		while True:
 			self.mainloop()
 			pygame.display.update()
+			self.clock.tick(60)
 
 	def process_events(self):
 		for e in pygame.event.get():
 			if e.type == pygame.QUIT:
+				self.core.stop()
 				exit()
 
 			if e.type == pygame.KEYDOWN:
 				if e.key == pygame.K_ESCAPE:
 					pygame.event.post(pygame.event.Event(pygame.QUIT))
 				if e.key == pygame.K_q:
-					self.do_one_instruction()
+					self.core.send('step')
 				if e.key == pygame.K_f:
-					self.do_instructions_until_frame_then_stop()
+					self.core.send('frame')
 				if e.key == pygame.K_w:
-					self.running = not self.running
+					self.core.send('run')
+				if e.key == pygame.K_t:
+					self.core.send('turbo')
 				if e.key == pygame.K_z:
 					sss = '00000000000000000000000000000000F000F000FC00FC00FC00FC00F300F3003C003C003C003C003C003C003C003C00F000F000F000F00000000000F300F300000000000000000000000000CF00CF00000000000F000F003F003F000F000F000000000000000000C000C0000F000F00000000000000000000000000F000F000000000000000000000000000F300F300000000000000000000000000C000C000030003000300030003000300FF00FF00C000C000C000C000C000C000C300C300000000000000000000000000FC00FC00F300F300F000F000F000F000F000F0003C003C00FC00FC00FC00FC003C003C00F300F300F300F300F300F300F300F300F300F300C300C300C300C300C300C300CF00CF00CF00CF00CF00CF00CF00CF003C003C003F003F003C003C000F000F003C003C00FC00FC0000000000FC00FC00FC00FC00F000F000F000F000F000F000F300F300F300F300F300F300F000F000C300C300C300C300C300C300FF00FF00CF00CF00CF00CF00CF00CF00C300C3000F000F000F000F000F000F00FC00FC003C004200B900A500B900A50042003C00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000'
-					for i in range(len(sss) // 2):
-						cur = sss[i*2:i*2+2]
-						x = int(cur, 16)
-						self.emu.bus.write_at(0x8000 + i, x)
+					self.core.send('write', 0x8000, bytes.fromhex(sss))
 
 			if e.type == pygame.MOUSEBUTTONDOWN:
 				mx, my = e.pos
@@ -196,34 +380,52 @@ class Game:
 
 		return None
 
+	def send_buttons(self):
+		keys = pygame.key.get_pressed()
+		buttons = 0
+		for key, btn in KEY_BUTTONS:
+			if keys[key]:
+				buttons |= btn
+		if buttons != self.buttons:
+			self.buttons = buttons
+			self.core.send('buttons', buttons)
+
 	def mainloop(self):
 		ev_state = self.process_events()
+		self.send_buttons()
 
-		if self.running:
-			self.do_instructions_until_frame()
+		if pygame.key.get_pressed()[pygame.K_BACKSPACE]:
+			# hold to step backwards a frame at a time
+			self.core.send('rewind')
 
+		snap = self.core.snapshot()
+		af, bc, de, hl, sp, pc = snap.regs
 		self.win.fill(pygame.Color(248, 248, 248))
-		self.win.blit(self.font.render(f'af= {self.emu.cpu.reg_af:0>4X}'), (336, 8))
-		self.win.blit(self.font.render(f'bc= {self.emu.cpu.reg_bc:0>4X}'), (336, 16))
-		self.win.blit(self.font.render(f'de= {self.emu.cpu.reg_de:0>4X}'), (336, 24))
-		self.win.blit(self.font.render(f'hl= {self.emu.cpu.reg_hl:0>4X}'), (336, 32))
-		self.win.blit(self.font.render(f'sp= {self.emu.cpu.reg_sp:0>4X}'), (336, 40))
-		self.win.blit(self.font.render(f'pc= {self.emu.cpu.reg_pc:0>4X}'), (336, 48))
-
-		self.win.blit(self.font.render(f'lcdc={self.emu.ioreg.data[0x40]:0>2X}'), (408, 8))
-		self.win.blit(self.font.render(f'stat={self.emu.ioreg.data[0x41]:0>2X}'), (408, 16))
-		self.win.blit(self.font.render(f'ly=  {self.emu.ioreg.data[0x44]:0>2X}'), (408, 24))
-
-		for y,s in enumerate(self.last_dis[::-1]):
-			self.win.blit(self.font.render(s), (336, 64 + y * 8))
+		self.get_screen(snap)
+		self.win.blit(self.screen_surf, (8, 8))
+		self.win.blit(self.font.render(f'af= {af:0>4X}'), (336, 8))
+		self.win.blit(self.font.render(f'bc= {bc:0>4X}'), (336, 16))
+		self.win.blit(self.font.render(f'de= {de:0>4X}'), (336, 24))
+		self.win.blit(self.font.render(f'hl= {hl:0>4X}'), (336, 32))
+		self.win.blit(self.font.render(f'sp= {sp:0>4X}'), (336, 40))
+		self.win.blit(self.font.render(f'pc= {pc:0>4X}'), (336, 48))
+
+		self.win.blit(self.font.render(f'lcdc={snap.lcdc:0>2X}'), (408, 8))
+		self.win.blit(self.font.render(f'stat={snap.stat:0>2X}'), (408, 16))
+		self.win.blit(self.font.render(f'ly=  {snap.ly:0>2X}'), (408, 24))
+
+		for y,ins in enumerate(reversed(snap.trace)):
+			self.win.blit(self.font.render(emu.disassemble(*ins)), (336, 64 + y * 8))
 		# ~ if not self.last_dis is None:
-		self.get_vram()
+		self.get_vram(snap)
 		if not self.vram_surf is None:
 			self.win.blit(self.vram_surf, (8, 304))
 		for y in range(8):
-			s = self.get_ram_row(0x800 + y)
+			s = self.get_ram_row(snap, y)
 			self.win.blit(self.font.render(s), (408, 304 + y * 8))
-		self.win.blit(self.font.render(f'{self.emu.bus.frame_cycles:>5}'), (480, 8))
+		self.win.blit(self.font.render(f'{snap.frame_cycles:>5}'), (480, 8))
+		if snap.turbo:
+			self.win.blit(self.font.render(f'turbo x{snap.skip}'), (480, 16))
 
 if __name__ == '__main__':
 	import sys
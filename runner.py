@@ -0,0 +1,94 @@
+import os, time, random, zlib
+import multiprocessing
+from multiprocessing import shared_memory
+import emu
+
+# set in each worker by init_worker
+_shm = None
+_rom_size = 0
+_bootrom = None
+
+def init_worker(shm_name, size, bootrom):
+	global _shm, _rom_size, _bootrom
+	_shm = shared_memory.SharedMemory(name=shm_name)
+	_rom_size = size
+	_bootrom = bootrom
+
+def frame_hash(e):
+	return zlib.crc32(e.ppu.frame)
+
+def run_job(job):
+	# job: dict with 'frames', and optionally 'id', 'seed' and 'inputs',
+	# a {frame: buttons} mapping applied at the start of that frame
+	job_id = job.get('id')
+	seed = job.get('seed', 0)
+	frames = job.get('frames', 60)
+	inputs = job.get('inputs', {})
+	result = {'id': job_id, 'seed': seed, 'pid': os.getpid()}
+	t = time.perf_counter()
+	try:
+		random.seed(seed)
+		e = emu.Emu(_bootrom)
+		e.load_rom(emu.ROM(_shm.buf[:_rom_size]))
+		hashes = []
+		for i in range(frames):
+			if i in inputs:
+				e.set_buttons(inputs[i])
+			if not e.bus.run_until_frame():
+				break
+			hashes.append(frame_hash(e))
+		result['frames'] = len(hashes)
+		result['frame_hashes'] = hashes
+		result['wram'] = bytes(e.wram.view)
+		result['cycles'] = e.bus.cycles
+		result['instructions'] = e.bus.instructions
+		result['error'] = None
+	except Exception as ex:
+		result['error'] = f'{type(ex).__name__}: {ex}'
+	result['elapsed'] = time.perf_counter() - t
+	return result
+
+def run_many(rom, jobs, processes=None, bootrom=None):
+	# runs every job in its own Emu across a process pool, yielding each
+	# result as soon as its worker finishes. The cartridge is read once
+	# into shared memory and every worker maps that same copy.
+	if isinstance(rom, str):
+		with open(rom, 'rb') as f:
+			data = f.read()
+	else:
+		data = bytes(rom)
+	shm = shared_memory.SharedMemory(create=True, size=len(data))
+	try:
+		shm.buf[:len(data)] = data
+		with multiprocessing.Pool(processes, init_worker, (shm.name, len(data), bootrom)) as pool:
+			for result in pool.imap_unordered(run_job, jobs):
+				yield result
+	finally:
+		shm.close()
+		shm.unlink()
+
+def main(argv=None):
+	import argparse
+	parser = argparse.ArgumentParser(description='Run many emulator instances in parallel')
+	parser.add_argument('rom')
+	parser.add_argument('--bootrom', default=None)
+	parser.add_argument('--instances', type=int, default=os.cpu_count())
+	parser.add_argument('--frames', type=int, default=600)
+	parser.add_argument('--processes', type=int, default=None)
+	args = parser.parse_args(argv)
+
+	jobs = [{'id': i, 'seed': i, 'frames': args.frames} for i in range(args.instances)]
+	t = time.perf_counter()
+	total = 0
+	for r in run_many(args.rom, jobs, args.processes, args.bootrom):
+		if r['error']:
+			print(f'#{r["id"]:<4} seed={r["seed"]:<6} ERROR {r["error"]}')
+			continue
+		total += r['frames']
+		last = r['frame_hashes'][-1] if r['frame_hashes'] else 0
+		print(f'#{r["id"]:<4} seed={r["seed"]:<6} {r["frames"]} frames in {r["elapsed"]:.2f} s, last frame {last:0>8X}, wram {zlib.crc32(r["wram"]):0>8X}')
+	dt = time.perf_counter() - t
+	print(f'{total} frames in {dt:.2f} s, {total / dt:.1f} frames/s overall')
+
+if __name__ == '__main__':
+	main()